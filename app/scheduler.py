@@ -33,7 +33,7 @@ APP_DIR = Path(__file__).resolve().parent
 ROOT_DIR = APP_DIR.parent
 sys.path.extend([str(APP_DIR), str(ROOT_DIR)])
 
-from etl.scrape_kaspi import collect
+from etl.scrape_kaspi import collect, relaunching_browser_session
 from notify import tg_send
 from economics import CostInputs, landed_cost, profit_per_unit
 from pricing import choose_price_grid
@@ -121,28 +121,31 @@ class TaskScheduler:
             all_items = []
             config = self.config["data_collection"]
             
-            for category in config["categories"]:
-                try:
-                    # Базовый запрос по категории
-                    items = collect(
-                        query_text=category,
-                        pages=config["pages"],
-                        delay=1.0,
-                        headful=False,
-                        mode="category",
-                        max_items=config["max_items"],
-                        detail_limit=0,
-                        category=category,
-                        sort="popularity"
-                    )
+            # один chromium на все категории, по контексту на категорию; упавший браузер перезапускается
+            with relaunching_browser_session(headful=False) as get_browser:
+                for category in config["categories"]:
+                    try:
+                        # Базовый запрос по категории
+                        items = collect(
+                            query_text=category,
+                            pages=config["pages"],
+                            delay=1.0,
+                            headful=False,
+                            mode="category",
+                            max_items=config["max_items"],
+                            detail_limit=0,
+                            category=category,
+                            sort="popularity",
+                            browser=get_browser(),
+                        )
                     
-                    all_items.extend(items)
-                    logger.info(f"Собрано {len(items)} товаров из категории {category}")
+                        all_items.extend(items)
+                        logger.info(f"Собрано {len(items)} товаров из категории {category}")
                     
-                except Exception as e:
-                    logger.error(f"Ошибка сбора данных для категории {category}: {e}")
-                    if self.config["telegram"]["send_errors"]:
-                        tg_send(f"❌ Ошибка сбора данных ({category}): {str(e)[:200]}")
+                    except Exception as e:
+                        logger.error(f"Ошибка сбора данных для категории {category}: {e}")
+                        if self.config["telegram"]["send_errors"]:
+                            tg_send(f"❌ Ошибка сбора данных ({category}): {str(e)[:200]}")
             
             if all_items:
                 # Сохраняем данные
@@ -1,4 +1,5 @@
 import argparse, os, time, subprocess, sys, pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 
 DEFAULT_TOPICS = [
     ("смартфон", "smartphones"),
@@ -19,6 +20,65 @@ def run_scrape(q, out, pages=6, delay=0.9, mode="search", brands=False, max_item
     print("RUN:", " ".join(cmd))
     subprocess.check_call(cmd)
 
+def topic_csv_path(q, cat, out_dir="tmp"):
+    return os.path.join(out_dir, f"{cat}_{q}.csv".replace(" ", "_"))
+
+def _load_scraper():
+    try:
+        from etl import scrape_kaspi
+    except Exception:
+        # запуск как файла (python etl/batch_runner.py)
+        here = os.path.dirname(os.path.abspath(__file__))
+        if here not in sys.path: sys.path.insert(0, here)
+        import scrape_kaspi
+    return scrape_kaspi
+
+def _scrape_bucket(sk, topics, out_dir, pages, delay, mode, brands, max_items):
+    results = {}
+    try:
+        # один chromium на поток; топики изолированы контекстами; упавший браузер поднимается заново
+        with sk.relaunching_browser_session() as get_browser:
+            for q, cat in topics:
+                print("RUN (in-process):", q, "->", topic_csv_path(q, cat, out_dir))
+                try:
+                    results[(q, cat)] = sk.collect(
+                        query_text=q, pages=pages, delay=delay, mode=mode,
+                        max_items=max_items, split_by_brand=brands, no_zone=True,
+                        browser=get_browser(),
+                    )
+                except Exception as e:
+                    print(f"WARN: scrape failed for '{q}' in '{cat}': {e}")
+    except Exception as e:
+        print(f"WARN: browser session failed: {e}")
+    return results
+
+def run_scrape_many(topics, out_dir="tmp", pages=6, delay=0.9, mode="search", brands=False, max_items=800,
+                    concurrency=1):
+    """Скрейпит все (q, cat) в текущем процессе и пишет CSV по каждому топику.
+
+    concurrency > 1 — топики делятся между потоками, у каждого свой sync_playwright
+    (sync API привязан к потоку); с KASPI_CDP_ENDPOINT все подключаются к одному chromium.
+    Возвращает {(q, cat): [Product, ...]}; упавшие топики пропускаются.
+    """
+    sk = _load_scraper()
+    topics = list(topics)
+    workers = max(1, min(int(concurrency or 1), len(topics)))
+    args = (out_dir, pages, delay, mode, brands, max_items)
+    if workers == 1:
+        results = _scrape_bucket(sk, topics, *args)
+    else:
+        buckets = [topics[i::workers] for i in range(workers)]
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            parts = list(ex.map(lambda b: _scrape_bucket(sk, b, *args), buckets))
+        merged = {}
+        for part in parts:
+            merged.update(part)
+        results = {t: merged[t] for t in topics if t in merged}
+    os.makedirs(out_dir, exist_ok=True)
+    for (q, cat), items in results.items():
+        sk.save_csv(items, topic_csv_path(q, cat, out_dir))
+    return results
+
 # Override DEFAULT_TOPICS with clean Cyrillic to avoid mojibake issues
 DEFAULT_TOPICS = [
     ("смартфоны", "smartphones"),
@@ -34,6 +94,9 @@ def main():
     ap.add_argument("--pages", type=int, default=6)
     ap.add_argument("--brands", action="store_true")
     ap.add_argument("--max-items", type=int, default=1000)
+    ap.add_argument("--isolate", action="store_true", help="каждый топик в отдельном подпроцессе")
+    ap.add_argument("--concurrency", type=int, default=int(os.getenv("KASPI_QUERY_CONCURRENCY", "1")),
+                    help="сколько топиков скрейпить параллельно (потоки, без --isolate)")
     args = ap.parse_args()
 
     topics = DEFAULT_TOPICS
@@ -45,10 +108,16 @@ def main():
             topics.append((q.strip(), cat.strip()))
 
     os.makedirs("tmp", exist_ok=True)
+    if args.isolate:
+        for q, cat in topics:
+            run_scrape(q, topic_csv_path(q, cat), pages=args.pages, brands=args.brands, max_items=args.max_items)
+        scraped = topics
+    else:
+        scraped = list(run_scrape_many(topics, pages=args.pages, brands=args.brands, max_items=args.max_items,
+                                       concurrency=args.concurrency))
     frames = []
-    for q, cat in topics:
-        out = f"tmp/{cat}_{q}.csv".replace(" ", "_")
-        run_scrape(q, out, pages=args.pages, brands=args.brands, max_items=args.max_items)
+    for q, cat in scraped:
+        out = topic_csv_path(q, cat)
         df = pd.read_csv(out, dtype=str)
         df["topic"] = q
         df["category_hint"] = cat
@@ -3,31 +3,28 @@ import argparse, csv, re, os, sys, math, json
 import pandas as pd
 from unidecode import unidecode
 
-# Примитивная транслитерация RU->slug
-RU_MAP = {
-    'ё':'e','й':'i','ю':'yu','я':'ya','ч':'ch','ш':'sh','щ':'sch','ж':'zh','х':'h','ц':'ts','ъ':'','ь':'',
-    'а':'a','б':'b','в':'v','г':'g','д':'d','е':'e','з':'z','и':'i','к':'k','л':'l','м':'m','н':'n','о':'o',
-    'п':'p','р':'r','с':'s','т':'t','у':'u','ф':'f','ы':'y','э':'e','й':'i'
-}
+# Транслитерация RU->slug целиком на Unidecode (ручная карта давала mojibake-артефакты)
+_SLUG_RE = re.compile(r'[^a-z0-9]+')
+_PRICE_RE = re.compile(r'(?:(?:\d{1,3}(?:[ \u00A0]\d{3})+)|\d+)(?:[.,]\d+)?')
+_PRICE_TRANS = str.maketrans({'\u00A0': '', ' ': '', ',': '.'})
+
 def ru_to_slug(s: str)->str:
     s = s.strip().lower()
-    # чередуем fast: unidecode + ручные замены
-    s2 = ''.join(RU_MAP.get(ch, ch) for ch in s)
-    s2 = unidecode(s2)
-    s2 = re.sub(r'[^a-z0-9]+','-', s2).strip('-')
+    if s.isascii():
+        # латиница (Apple iPhone 15 ...) — транслитерация не нужна
+        return _SLUG_RE.sub('-', s).strip('-').replace('-gb', 'gb')
+    s2 = unidecode(s)
+    s2 = _SLUG_RE.sub('-', s2).strip('-')
     # косметика для «gb/гб»
     s2 = s2.replace('-gb', 'gb').replace('gb-', 'gb-')
     return s2
 
-# Override RU_MAP to rely solely on Unidecode (avoid mojibake transliteration artifacts)
-RU_MAP = {}
-
 def price_to_float(x):
     if pd.isna(x): return math.nan
     s = str(x)
-    m = re.search(r'(?:(?:\d{1,3}(?:[ \u00A0]\d{3})+)|\d+)(?:[.,]\d+)?', s)
+    m = _PRICE_RE.search(s)
     if not m: return math.nan
-    return float(m.group(0).replace('\u00A0',' ').replace(' ','').replace(',','.'))
+    return float(m.group(0).translate(_PRICE_TRANS))
 
 def build_url(title, pid, city="750000000"):
     if not pid or not title: return None
@@ -96,11 +96,21 @@ def discover_topics(config_path: Path | None) -> List[Tuple[str, str]]:
         return DEFAULT_TOPICS
 
 
+# Text columns of the scraper CSV; everything else is parsed natively by read_csv
+CSV_TEXT_DTYPES = {
+    "product_id": "string",
+    "title": "string",
+    "url": "string",
+    "best_merchant": "string",
+    "errors": "string",
+}
+
+
 def normalize_df(df: pd.DataFrame) -> pd.DataFrame:
-    df = df.fillna("")
-    # numeric-like columns
+    df = df.fillna({c: "" for c in df.columns if not pd.api.types.is_numeric_dtype(df[c])})
+    # numeric-like columns (already numeric when read with CSV_TEXT_DTYPES)
     for c in ["list_price", "price_min", "price_default", "rating", "reviews", "offers_count"]:
-        if c in df.columns:
+        if c in df.columns and not pd.api.types.is_numeric_dtype(df[c]):
             if c in ("rating",):
                 df[c] = pd.to_numeric(df[c], errors="coerce")
             else:
@@ -166,6 +176,37 @@ def _tg_send_file(path: Path, caption: str = "") -> bool:
         return False
 
 
+def _top_topics(df: pd.DataFrame, n: int = 5) -> List[Tuple[str, int]]:
+    """Topics ranked by number of unique SKUs (Arrow group_by when available).
+
+    Both paths skip null topics and null product_ids and break ties by topic name,
+    so the result does not depend on whether pyarrow is installed.
+    """
+    try:
+        import pyarrow as pa  # type: ignore
+        import pyarrow.compute as pc  # type: ignore
+    except ImportError:
+        top = (
+            df.groupby("topic")["product_id"]
+            .nunique()
+            .rename("count")
+            .reset_index()
+            .sort_values(["count", "topic"], ascending=[False, True])
+            .head(n)
+        )
+        return [(topic, int(cnt)) for topic, cnt in zip(top["topic"], top["count"])]
+
+    tbl = pa.Table.from_pandas(df[["topic", "product_id"]], preserve_index=False)
+    tbl = tbl.filter(pc.is_valid(tbl["topic"]))
+    top = (
+        tbl.group_by("topic")
+        .aggregate([("product_id", "count_distinct")])
+        .sort_by([("product_id_count_distinct", "descending"), ("topic", "ascending")])
+        .slice(0, n)
+    )
+    return list(zip(top["topic"].to_pylist(), top["product_id_count_distinct"].to_pylist()))
+
+
 def notify_telegram(df: pd.DataFrame, latest_path: Path, daily_path: Path) -> None:
     if df.empty:
         return
@@ -177,14 +218,17 @@ def notify_telegram(df: pd.DataFrame, latest_path: Path, daily_path: Path) -> No
         f"Всего записей: <b>{total}</b> (SKU: {unique_products})",
     ]
     if unique_topics:
-        top_topics = df.groupby("topic")["product_id"].nunique().sort_values(ascending=False).head(5)
         lines.append("ТОП запросов:")
-        for topic, cnt in top_topics.items():
+        for topic, cnt in _top_topics(df, 5):
             lines.append(f"• {topic}: {cnt}")
     if "price_min" in df.columns:
-        tmp = df.copy()
-        tmp["price_min"] = pd.to_numeric(tmp["price_min"], errors="coerce")
-        best = tmp.dropna(subset=["price_min"]).sort_values("price_min").head(5)
+        cols = ["price_min"] + (["title"] if "title" in df.columns else [])
+        best = (
+            df[cols]
+            .assign(price_min=lambda d: pd.to_numeric(d["price_min"], errors="coerce"))
+            .dropna(subset=["price_min"])
+            .nsmallest(5, "price_min")
+        )
         if not best.empty:
             lines.append("Самые доступные предложения:")
             for _, row in best.iterrows():
@@ -209,33 +253,55 @@ def main() -> None:
     ap.add_argument("--split-by-brand", action="store_true")
     ap.add_argument("--out-latest", dest="out_latest", default="data/latest/market_snapshot.csv")
     ap.add_argument("--daily-dir", dest="daily_dir", default="data/daily")
+    ap.add_argument("--isolate", action="store_true", help="Run each topic in a separate scraper subprocess")
+    ap.add_argument(
+        "--concurrency",
+        type=int,
+        default=int(os.getenv("KASPI_QUERY_CONCURRENCY", "1")),
+        help="Topics scraped in parallel (threads, each with its own Playwright); ignored with --isolate",
+    )
     args = ap.parse_args()
 
     config_path = Path(args.config)
     topics = discover_topics(config_path)
 
     ensure_dir("tmp")
-    frames: List[pd.DataFrame] = []
-    for q, cat in topics:
-        out_path = Path("tmp") / f"{cat}_{q}.csv"
-        # Run scraper via the helper (subprocess to the real scraper)
-        try:
-            batch_runner.run_scrape(
-                q=q,
-                out=str(out_path),
-                pages=args.pages,
-                delay=args.delay,
-                mode="both",
-                brands=args.split_by_brand,
-                max_items=args.max_items,
-            )
-        except Exception as e:
-            print(f"WARN: scrape failed for '{q}' in '{cat}': {e}")
-            continue
+    scraped: List[Tuple[str, str]] = []
+    if args.isolate:
+        for q, cat in topics:
+            # Run scraper via the helper (subprocess to the real scraper)
+            try:
+                batch_runner.run_scrape(
+                    q=q,
+                    out=batch_runner.topic_csv_path(q, cat),
+                    pages=args.pages,
+                    delay=args.delay,
+                    mode="both",
+                    brands=args.split_by_brand,
+                    max_items=args.max_items,
+                )
+            except Exception as e:
+                print(f"WARN: scrape failed for '{q}' in '{cat}': {e}")
+                continue
+            scraped.append((q, cat))
+    else:
+        # All topics in this process: Playwright is imported once
+        scraped = list(batch_runner.run_scrape_many(
+            topics,
+            pages=args.pages,
+            delay=args.delay,
+            mode="both",
+            brands=args.split_by_brand,
+            max_items=args.max_items,
+            concurrency=args.concurrency,
+        ))
 
+    frames: List[pd.DataFrame] = []
+    for q, cat in scraped:
+        out_path = Path(batch_runner.topic_csv_path(q, cat))
         if out_path.exists():
             try:
-                df = pd.read_csv(out_path, dtype=str)
+                df = pd.read_csv(out_path, dtype=CSV_TEXT_DTYPES)
                 df["topic"] = q
                 df["category_hint"] = cat
                 frames.append(df)
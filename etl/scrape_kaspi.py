@@ -1,19 +1,63 @@
 # etl/scrape_kaspi.py
 import argparse
+import atexit
 import csv
+import hashlib
+import itertools
 import json
 import logging
+import operator
 import random
 import re
 import sys
 import time
 import os
-from dataclasses import dataclass, asdict
-from typing import List, Dict, Optional, Set, Tuple, Iterable, Callable, Any
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import List, Dict, Optional, Set, Tuple, Iterable, Callable, Any, Union
 from urllib.parse import quote, urlparse, parse_qs, urlencode, urlunparse
 
 from playwright.sync_api import sync_playwright, TimeoutError as PWTimeout
 
+# orjson опционален: быстрее на больших XHR/GraphQL, без него — stdlib json
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+# httpx (HTTP/2) опционален: XHR-пагинация по JSON API без браузерного request-контекста
+try:
+    import httpx
+except Exception:
+    httpx = None
+
+def _json_loads(raw):
+    """str/bytes -> объект (orjson, если установлен).
+    orjson строже stdlib (NaN/Infinity, невалидный UTF-8) — такие ответы добираем через json."""
+    if orjson is not None:
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(raw)
+
+def _json_dumps(obj, indent: bool = False) -> str:
+    if orjson is not None:
+        opt = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=opt, default=str).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None, default=str)
+
+def _json_dumpb(obj) -> bytes:
+    """Компактный JSON сразу в UTF-8 байтах (orjson отдаёт bytes без лишнего decode/encode)."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY, default=str)
+    return json.dumps(obj, ensure_ascii=False, default=str).encode("utf-8")
+
 # ---------------------- Logging ----------------------
 logging.basicConfig(
     level=logging.INFO,
@@ -37,6 +81,14 @@ class Product:
     best_merchant: Optional[str] = None
     errors: Optional[str] = None
 
+# Правила апсерта дублей: цены дозаполняем только если их не было (0 — валидная цена),
+# остальное — если пусто/0 (рейтинг 0 на kaspi означает «нет отзывов»)
+_MERGE_IF_NONE = ("list_price", "price_min", "price_default")
+_MERGE_IF_EMPTY = ("url", "rating", "reviews", "best_merchant", "offers_count")
+
+# Поля цены в объекте карточки XHR-пагинации, по убыванию приоритета
+_XHR_PRICE_KEYS = ("unitSalePrice", "unitPrice", "priceFormatted", "price", "listPrice", "minPrice", "priceMin")
+
 @dataclass
 class CapturedEndpoint:
     method: str
@@ -45,6 +97,9 @@ class CapturedEndpoint:
     req_body: Optional[str]        # raw body (str)
     resp_json: Optional[dict]      # parsed JSON
 
+# Префикс для относительных ссылок карточек (/shop/p/...)
+KASPI_ORIGIN = "https://kaspi.kz"
+
 # ---------------------- Selectors ----------------------
 CARD_SELECTORS = [
     'article[data-product-id]',
@@ -53,6 +108,7 @@ CARD_SELECTORS = [
     'div[itemtype*="Product"]',
     'a[href*="/shop/p/"]'
 ]
+_CARD_SEL_UNION = ", ".join(CARD_SELECTORS)
 
 LOAD_MORE_SELECTORS = [
     'button:has-text("Показать ещё")',
@@ -68,27 +124,465 @@ ALL_LOAD_MORE_SELECTORS = (
         'div[data-test="load-more"] button',
     ]
 )
+# Один локатор на все варианты кнопки: наличие проверяется одним count() вместо count() на селектор
+_LOAD_MORE_COMBINED = ", ".join(dict.fromkeys(ALL_LOAD_MORE_SELECTORS))
+
+# ---------------------- Regexes ----------------------
+_PRICE_RE = re.compile(r'(?:(?:\d{1,3}(?:[ \u00A0]\d{3})+)|\d+)(?:[.,]\d+)?')
+_PRICE_TRANS = str.maketrans({'\u00A0': '', ' ': '', ',': '.'})
+_INT_TRANS = str.maketrans({'\u00A0': '', ' ': ''})
+_ZONE_RE = re.compile(r":availableInZones:[A-Za-z0-9_\-]+")
+_DIGITS_RE = re.compile(r"\d+")
+_NONDIGIT_RE = re.compile(r"\D+")
+_REVIEWS_RE = re.compile(r"(\d+)[^\d]*отзыв", re.I)
+_REVIEWS_PAREN_RE = re.compile(r"\((\d+)\)")
+_RATING_RE = re.compile(r"(\d+(?:[\.,]\d+)?)\s*из\s*5")
 
 # ---------------------- Utils ----------------------
-def _ctx_opts() -> dict:
-    ua = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-          "(KHTML, like Gecko) Chrome/140.0.0.0 Safari/537.36 Edg/140.0.0.0")
+# Десктопные профили на движке Chromium (UA не расходится с реальными возможностями браузера).
+# Локаль/таймзона общие — выдача kaspi от них зависит.
+UA_PROFILES: List[Tuple[str, Dict[str, int]]] = [
+    ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+     "(KHTML, like Gecko) Chrome/140.0.0.0 Safari/537.36 Edg/140.0.0.0", {"width": 1366, "height": 800}),
+    ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+     "(KHTML, like Gecko) Chrome/140.0.0.0 Safari/537.36", {"width": 1920, "height": 1080}),
+    ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+     "(KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36", {"width": 1536, "height": 864}),
+    ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+     "(KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36 Edg/139.0.0.0", {"width": 1440, "height": 900}),
+    ("Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 "
+     "(KHTML, like Gecko) Chrome/140.0.0.0 Safari/537.36", {"width": 1440, "height": 900}),
+    ("Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 "
+     "(KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36", {"width": 1680, "height": 1050}),
+    ("Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+     "(KHTML, like Gecko) Chrome/140.0.0.0 Safari/537.36", {"width": 1920, "height": 1080}),
+    ("Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+     "(KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36", {"width": 1366, "height": 768}),
+    ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+     "(KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36", {"width": 1600, "height": 900}),
+    ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+     "(KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36 Edg/138.0.0.0", {"width": 1280, "height": 720}),
+]
+# Ротация профилей по контекстам (KASPI_ROTATE_UA=1); по умолчанию — всегда первый профиль, как раньше
+ROTATE_UA = bool(int(os.getenv("KASPI_ROTATE_UA", "0")))
+# Контексты открываются из потоков бакетов/брендов — itertools.count атомарен под GIL, в отличие от += 1
+_profile_counter = itertools.count()
+
+def _next_profile_idx() -> int:
+    if not ROTATE_UA:
+        return 0
+    return next(_profile_counter) % len(UA_PROFILES)
+
+def _ua_platform(ua: str) -> str:
+    """navigator.platform, согласованный с ОС из UA."""
+    if "Macintosh" in ua:
+        return "MacIntel"
+    if "Linux" in ua:
+        return "Linux x86_64"
+    return "Win32"
+
+def _ctx_opts(profile_idx: int = 0) -> dict:
+    ua, viewport = UA_PROFILES[profile_idx % len(UA_PROFILES)]
     return {
         "locale": "ru-RU",
         "timezone_id": "Asia/Almaty",
         "user_agent": ua,
-        "viewport": {"width": 1366, "height": 800},
+        "viewport": dict(viewport),
         "extra_http_headers": {
             "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
             "Accept-Language": "ru-RU,ru;q=0.9,en-US;q=0.8",
         }
     }
 
+# Картинки/шрифты/стили/трекеры не нужны ни для DOM, ни для XHR — режем на уровне контекста
+BLOCK_ASSETS = bool(int(os.getenv("KASPI_BLOCK_ASSETS", "0")))
+BLOCKED_RESOURCE_TYPES = frozenset({"image", "font", "media", "stylesheet"})
+BLOCKED_HOSTS = ("googletagmanager", "mc.yandex", "google-analytics", "doubleclick", "facebook")
+
+# Дисковый кэш JSON-ответов листинга: повторные прогоны/ретраи не ходят в сеть (0 = выключен)
+HTTP_CACHE_TTL = float(os.getenv("KASPI_HTTP_CACHE_TTL", "0") or 0)
+HTTP_CACHE_DIR = os.path.join(".cache", "kaspi")
+CACHEABLE_URL_PARTS = ("/pl/results", "/pl/filters", "graphql")
+
+def _cache_path(method: str, url: str, body: Optional[str]) -> str:
+    h = hashlib.blake2b(f"{method} {url}\n{body or ''}".encode("utf-8"), digest_size=16)
+    return os.path.join(HTTP_CACHE_DIR, f"{h.hexdigest()}.json")
+
+def _cache_fresh(path: str) -> bool:
+    try:
+        return time.time() - os.path.getmtime(path) < HTTP_CACHE_TTL
+    except OSError:
+        return False
+
+def _is_cacheable(url: str) -> bool:
+    return any(part in url for part in CACHEABLE_URL_PARTS)
+
+def _route_handler(route):
+    req = route.request
+    try:
+        if BLOCK_ASSETS and (req.resource_type in BLOCKED_RESOURCE_TYPES or any(h in req.url for h in BLOCKED_HOSTS)):
+            route.abort()
+            return
+        if HTTP_CACHE_TTL > 0 and _is_cacheable(req.url):
+            path = _cache_path(req.method, req.url, req.post_data)
+            if _cache_fresh(path):
+                with open(path, "rb") as f:
+                    route.fulfill(status=200, content_type="application/json", body=f.read())
+                return
+        route.continue_()
+    except Exception as e:
+        # кэш-файл мог исчезнуть после _cache_fresh, fulfill/abort — упасть: не оставляем запрос висеть
+        logger.debug("route handler failed (%s): %s", req.url, e)
+        try:
+            route.continue_()
+        except Exception:
+            pass
+
+def _on_response_cache(resp):
+    try:
+        req = resp.request
+        if not resp.ok or not _is_cacheable(req.url) or not _is_json_like(dict(resp.headers)):
+            return
+        path = _cache_path(req.method, req.url, req.post_data)
+        if _cache_fresh(path):
+            return  # это наш же fulfill — не продлеваем TTL
+        body = resp.body()
+        _ensure_dir(HTTP_CACHE_DIR)
+        with open(path, "wb") as f:
+            f.write(body)
+    except Exception as e:
+        logger.debug("http cache store failed: %s", e)
+
+def _install_routes(ctx) -> None:
+    if BLOCK_ASSETS or HTTP_CACHE_TTL > 0:
+        ctx.route("**/*", _route_handler)
+    if HTTP_CACHE_TTL > 0:
+        ctx.on("response", _on_response_cache)
+
+# Общий chromium, запущенный отдельно (launch_cdp.sh): воркеры только подключаются и открывают свои контексты
+CDP_ENDPOINT = os.getenv("KASPI_CDP_ENDPOINT", "")
+
+def _launch_browser(p, headful: bool, proxy: Optional[str] = ""):
+    if CDP_ENDPOINT:
+        logger.info("Подключаюсь к chromium по CDP: %s", CDP_ENDPOINT)
+        return p.chromium.connect_over_cdp(CDP_ENDPOINT)
+    if proxy:
+        return p.chromium.launch(headless=not headful, proxy={"server": proxy})
+    return p.chromium.launch(headless=not headful)
+
+# Маскировка автоматизации: webdriver-флаг, window.chrome, languages как у обычного Chrome
+_STEALTH_JS = """
+(() => {
+  try { Object.defineProperty(Navigator.prototype, 'webdriver', { get: () => undefined }); } catch (e) {}
+  try { if (!window.chrome) window.chrome = { runtime: {}, app: { isInstalled: false } }; } catch (e) {}
+  try { Object.defineProperty(navigator, 'languages', { get: () => ['ru-RU', 'ru', 'en-US', 'en'] }); } catch (e) {}
+  try {
+    const q = window.navigator.permissions && window.navigator.permissions.query;
+    if (q) {
+      window.navigator.permissions.query = (p) => (p && p.name === 'notifications')
+        ? Promise.resolve({ state: Notification.permission }) : q.call(window.navigator.permissions, p);
+    }
+  } catch (e) {}
+})();
+"""
+
+def _new_context(browser, proxy: Optional[str] = "", profile_idx: int = 0):
+    opts = _ctx_opts(profile_idx)
+    if proxy and CDP_ENDPOINT:
+        # у чужого браузера прокси запуска не задать — ставим на контекст
+        opts["proxy"] = {"server": proxy}
+    ctx = browser.new_context(**opts)
+    _install_routes(ctx)
+    try:
+        ctx.add_init_script(_STEALTH_JS)
+        platform = _ua_platform(opts["user_agent"])
+        ctx.add_init_script(
+            "try { Object.defineProperty(Navigator.prototype, 'platform', { get: () => %s }); } catch (e) {}"
+            % json.dumps(platform)
+        )
+        ctx.add_init_script(_DISMISS_INIT_JS)
+        ctx.add_init_script(_IDS_OBSERVER_JS)
+    except Exception as e:
+        logger.debug("init-script для контекста не поставлен: %s", e)
+    return ctx
+
+@contextmanager
+def browser_session(headful: bool = False, proxy: Optional[str] = ""):
+    """Один playwright + chromium на весь прогон (батч тем/категорий/брендов).
+    Каждый _collect_one_query внутри открывает и закрывает только свой контекст.
+    """
+    with sync_playwright() as p:
+        browser = _launch_browser(p, headful, proxy)
+        try:
+            yield browser
+        finally:
+            # дампы пишет фоновый поток — дожидаемся их до закрытия браузера/выхода
+            _flush_dumps()
+            _close_browser(browser)
+
+def _close_browser(browser) -> None:
+    """Закрывает браузер вместе с привязанными к нему общим контекстом и httpx-клиентами."""
+    shared_ctx = _SHARED_CONTEXTS.pop(id(browser), None)
+    shared_http = [_SHARED_HTTP_CLIENTS.pop(k) for k in list(_SHARED_HTTP_CLIENTS) if k[0] == id(browser)]
+    for closable in (*shared_http, shared_ctx, browser):
+        if closable is None:
+            continue
+        try:
+            closable.close()
+        except Exception:
+            pass
+
+@contextmanager
+def relaunching_browser_session(headful: bool = False, proxy: Optional[str] = ""):
+    """browser_session для батчей (категории/топики): отдаёт функцию, возвращающую живой браузер.
+    Перед каждым запросом зовите её заново: если chromium упал или отключился, поднимается новый
+    в том же playwright, и остальные запросы прогона не падают на мёртвом браузере.
+    Ошибка запуска всплывает из вызова — её ловит обработчик конкретного запроса."""
+    with sync_playwright() as p:
+        current: List[Any] = [None]
+
+        def _get_browser():
+            browser = current[0]
+            if browser is not None:
+                try:
+                    if browser.is_connected():
+                        return browser
+                except Exception:
+                    pass
+                logger.warning("Браузер отключился — перезапускаю")
+                current[0] = None
+                _close_browser(browser)
+            current[0] = _launch_browser(p, headful, proxy)
+            return current[0]
+
+        try:
+            yield _get_browser
+        finally:
+            _flush_dumps()
+            if current[0] is not None:
+                _close_browser(current[0])
+
+@contextmanager
+def _browser_scope(browser, headful: bool, proxy: Optional[str] = ""):
+    # чужой (общий) браузер не закрываем — им владеет browser_session
+    if browser is not None:
+        yield browser
+        return
+    with browser_session(headful, proxy) as own:
+        yield own
+
+# Один контекст (куки, TLS-сессии) на весь browser_session вместо нового на каждый запрос.
+# Только для общего браузера; ротация UA при этом сводится к профилю первого контекста.
+REUSE_CONTEXT = bool(int(os.getenv("KASPI_REUSE_CONTEXT", "0")))
+_SHARED_CONTEXTS: Dict[int, Any] = {}  # id(browser) -> context; закрывает browser_session
+# (id(browser), proxy) -> httpx.Client: пул соединений (TLS/HTTP2) живёт весь browser_session,
+# куки перед каждым запросом берутся из его контекста. Закрывает browser_session
+_SHARED_HTTP_CLIENTS: Dict[Tuple[int, str], Any] = {}
+
+@contextmanager
+def _context_scope(browser, proxy: Optional[str] = "", profile_idx: int = 0, shared: bool = False):
+    if shared and REUSE_CONTEXT:
+        ctx = _SHARED_CONTEXTS.get(id(browser))
+        if ctx is None:
+            ctx = _new_context(browser, proxy, profile_idx)
+            _SHARED_CONTEXTS[id(browser)] = ctx
+        try:
+            yield ctx
+        finally:
+            # контекст живёт дальше, а вкладки этого запроса — нет
+            for pg in list(ctx.pages):
+                try:
+                    pg.close()
+                except Exception:
+                    pass
+        return
+    ctx = _new_context(browser, proxy, profile_idx)
+    try:
+        yield ctx
+    finally:
+        try:
+            ctx.close()
+        except Exception:
+            pass
+
+# XHR-пагинацию гоняем через один keep-alive HTTP/2 клиент с куками контекста; иначе — ctx.request
+HTTPX_PAGINATION = bool(int(os.getenv("KASPI_HTTPX", "1")))
+# Сколько XHR листинга держать в полёте одновременно: страницы /pl/results, когда endpoint уже пойман,
+# и варианты параметров offset-пагинации
+RESULTS_CONCURRENCY = max(1, int(os.getenv("KASPI_RESULTS_CONCURRENCY", "4")))
+
+class _HttpxResponse:
+    """Минимальный адаптер под интерфейс APIResponse (ok/status/json/body), который ждёт XHR-код."""
+    def __init__(self, resp):
+        self._resp = resp
+        self.status = resp.status_code
+        self.ok = 200 <= resp.status_code < 300
+        self.headers = dict(resp.headers)
+
+    def body(self) -> bytes:
+        return self._resp.content
+
+    def json(self):
+        return _json_loads(self._resp.content)
+
+class _ApiClient:
+    """GET через httpx; если ответ не 2xx или не JSON (челлендж/HTML) — повтор через Playwright ctx.request.
+    Один клиент на весь запрос (см. _api_scope): httpx создаётся при первом GET, чтобы забрать куки,
+    которые kaspi выставил уже после открытия листинга; дальше соединения переиспользуются.
+    shared_key — общий браузер: клиент (и его соединения) переходит к следующим запросам сессии."""
+    def __init__(self, ctx, proxy: Optional[str] = "", shared_key: Optional[int] = None):
+        self._ctx = ctx
+        self._proxy = proxy
+        self._fallback = ctx.request
+        self._client = None
+        self._owned = True
+        self._shared_key = (shared_key, proxy or "") if shared_key is not None else None
+        self._tried = not (HTTPX_PAGINATION and httpx is not None)
+
+    def _ensure_client(self) -> None:
+        if self._tried:
+            return
+        self._tried = True
+        try:
+            jar = httpx.Cookies()
+            for c in self._ctx.cookies():
+                jar.set(c["name"], c["value"], domain=c.get("domain", ""), path=c.get("path", "/"))
+            shared = _SHARED_HTTP_CLIENTS.get(self._shared_key) if self._shared_key else None
+            if shared is not None:
+                shared.cookies = jar
+                self._client = shared
+                self._owned = False
+                return
+            kw = {
+                "http2": True, "cookies": jar, "follow_redirects": True,
+                "limits": httpx.Limits(max_connections=max(8, RESULTS_CONCURRENCY), max_keepalive_connections=8),
+            }
+            if self._proxy:
+                kw["proxy"] = self._proxy
+            self._client = httpx.Client(**kw)
+            if self._shared_key:
+                _SHARED_HTTP_CLIENTS[self._shared_key] = self._client
+                self._owned = False
+        except Exception as e:
+            # нет h2 / старый httpx — остаёмся на ctx.request
+            logger.info("httpx-клиент недоступен (%s) — XHR через Playwright.", e)
+            self._client = None
+
+    def get(self, url: str, timeout: float = 25000, headers: Optional[Dict[str, str]] = None):
+        self._ensure_client()
+        if self._client is not None:
+            try:
+                r = self._client.get(url, headers=headers, timeout=timeout / 1000)
+                resp = _HttpxResponse(r)
+                if resp.ok and _is_json_like(resp.headers):
+                    return resp
+                logger.debug("httpx %s -> HTTP %s (%s) — повтор через Playwright", url, resp.status,
+                             resp.headers.get("content-type", ""))
+            except Exception as e:
+                logger.debug("httpx GET %s упал: %s — повтор через Playwright", url, e)
+        return self._fallback.get(url, timeout=timeout, headers=headers)
+
+    def get_many(self, urls: List[str], timeout: float = 25000, headers: Optional[Dict[str, str]] = None,
+                 workers: int = 4, json_only: bool = True,
+                 errors: Optional[Dict[str, Exception]] = None) -> List[Any]:
+        """Параллельный GET (httpx.Client потокобезопасен). Неудачные/не-JSON ответы повторяем
+        последовательно через ctx.request — Playwright из чужих потоков трогать нельзя.
+        json_only=False — для HTML: повторяем только не-2xx.
+        Возвращает ответы в порядке urls; None — если упал и фолбэк (причина — в errors[url], если передан)."""
+        out: List[Any] = [None] * len(urls)
+        httpx_errors: List[Optional[Exception]] = [None] * len(urls)
+        self._ensure_client()
+        if self._client is not None and urls:
+            def _one(url: str):
+                try:
+                    return _HttpxResponse(self._client.get(url, headers=headers, timeout=timeout / 1000)), None
+                except Exception as e:
+                    return None, e
+            with ThreadPoolExecutor(max_workers=max(1, min(workers, len(urls)))) as pool:
+                out, httpx_errors = map(list, zip(*pool.map(_one, urls)))
+        for i, url in enumerate(urls):
+            resp = out[i]
+            # 403 отдаём как есть: это сигнал анти-бота, вызывающий сам решит, уходить ли в UI
+            if resp is not None and (resp.status == 403 or (resp.ok and (not json_only or _is_json_like(resp.headers)))):
+                continue
+            try:
+                out[i] = self._fallback.get(url, timeout=timeout, headers=headers)
+            except Exception as e:
+                if httpx_errors[i] is not None:
+                    logger.info("GET %s упал: httpx — %s; ctx.request — %s", url, httpx_errors[i], e)
+                else:
+                    logger.debug("ctx.request GET %s упал: %s", url, e)
+                if errors is not None:
+                    errors[url] = e
+                out[i] = None
+        return out
+
+    def close(self) -> None:
+        if self._client is not None and self._owned:
+            try:
+                self._client.close()
+            except Exception:
+                pass
+            self._client = None
+
+@contextmanager
+def _api_scope(ctx, proxy: Optional[str] = "", shared_key: Optional[int] = None):
+    api = _ApiClient(ctx, proxy, shared_key=shared_key)
+    try:
+        yield api
+    finally:
+        api.close()
+
 def _ensure_dir(path: str):
     os.makedirs(path, exist_ok=True)
 
+# Автозакрытие cookie/регион-баннеров прямо в странице (add_init_script на контекст):
+# MutationObserver кликает кнопки, как только они появились, без round-trip'ов из Python.
+# Только известные баннеры: общие «Закрыть»/«Да» не трогаем — их модалки (фильтр брендов,
+# human-режим) открываем сами. После первого нажатия или таймаута наблюдатель отключается.
+_DISMISS_CSS = [
+    '[class*="cookie"] button', '[id*="cookie"] button',
+    '[data-test="region-confirm"]', '[data-testid="region-confirm"]',
+]
+# Подтверждение города — по точному тексту и только внутри city/region-попапа
+_DISMISS_CITY_SCOPE = '[class*="city"], [class*="region"], [data-test*="city"], [data-test*="region"]'
+_DISMISS_CITY_TEXTS = ["Алматы", "Да"]
+_DISMISS_TIMEOUT_MS = 15000
+_DISMISS_INIT_JS = """
+(() => {
+  const CSS = %s;
+  const CITY_SCOPE = %s;
+  const CITY_TEXTS = new Set(%s.map(t => t.toLowerCase()));
+  let obs = null, t = null, stopped = false;
+  const stop = () => { stopped = true; if (obs) obs.disconnect(); if (t) clearTimeout(t); };
+  const press = (el) => { if (!el || stopped) return false; try { el.click(); } catch (e) { return false; } stop(); return true; };
+  const sweep = () => {
+    for (const sel of CSS) {
+      try { if (press(document.querySelector(sel))) return; } catch (e) {}
+    }
+    try {
+      for (const box of document.querySelectorAll(CITY_SCOPE)) {
+        for (const b of box.querySelectorAll('button')) {
+          if (CITY_TEXTS.has((b.innerText || '').trim().toLowerCase()) && press(b)) return;
+        }
+      }
+    } catch (e) {}
+  };
+  const start = () => {
+    sweep();
+    if (stopped) return;
+    obs = new MutationObserver(() => { if (!t && !stopped) t = setTimeout(() => { t = null; sweep(); }, 150); });
+    obs.observe(document.documentElement, { subtree: true, childList: true });
+    setTimeout(stop, %d);
+  };
+  if (document.documentElement) start();
+  else document.addEventListener('readystatechange', start, { once: true });
+})();
+""" % (json.dumps(_DISMISS_CSS), json.dumps(_DISMISS_CITY_SCOPE),
+       json.dumps(_DISMISS_CITY_TEXTS, ensure_ascii=False), _DISMISS_TIMEOUT_MS)
+
 def _dismiss(page):
-    # cookie/consent + модалки
+    # cookie/consent + модалки; основную работу делает _DISMISS_INIT_JS, здесь — страховка после загрузки
     sels = [
         'button:has-text("Понятно")', 'button:has-text("Согласен")',
         'button:has-text("Согласиться")', 'button:has-text("Accept")',
@@ -105,48 +599,150 @@ def _dismiss(page):
         except Exception:
             pass
 
+def _num_or_none(v: Any, cast: Callable[[Any], Any]) -> Any:
+    """float/int из JSON-значения: числа — без try/except, строки и прочее — через cast с откатом в None."""
+    t = type(v)
+    if t is int or t is cast:
+        return cast(v)
+    if v is None:
+        return None
+    try:
+        return cast(v)
+    except Exception:
+        return None
+
 def _regex_price_to_float(text: Optional[str]) -> Optional[float]:
     if not text:
         return None
-    m = re.search(r'(?:(?:\d{1,3}(?:[ \u00A0]\d{3})+)|\d+)(?:[.,]\d+)?', str(text))
+    t = type(text)
+    # Числа из XHR-JSON — без str()/разбора. Результат как у regex по str(): знак отбрасывается;
+    # NaN/inf и экспоненциальная запись (str() даёт "1e+16") идут общим путём
+    if t is int:
+        return float(abs(text))
+    if t is float and 1e-4 <= abs(text) < 1e16:
+        return abs(text)
+    text = str(text)
+    # Быстрый путь: itemprop content и JSON обычно отдают уже чистое число ("123990" / "123990.5")
+    if text.isascii() and text[0].isdigit() and text.replace('.', '', 1).isdigit():
+        return float(text)
+    m = _PRICE_RE.search(text)
     if not m:
         return None
-    num = m.group(0).replace('\u00A0', ' ').replace(' ', '').replace(',', '.')
+    num = m.group(0).translate(_PRICE_TRANS)
     try:
         return float(num)
     except Exception:
         return None
 
+# Первый сработавший селектор из CARD_SELECTORS и число карточек — за один round-trip.
+# Объединённый селектор тут не годится: он ловит и вложенные a[href*="/shop/p/"] внутри article → дубли.
+_FIRST_CARD_SELECTOR_JS = """
+(selectors) => {
+  for (const sel of selectors) {
+    const n = document.querySelectorAll(sel).length;
+    if (n) return [sel, n];
+  }
+  return [null, 0];
+}
+"""
+
+def _first_card_selector(page) -> Tuple[Optional[str], int]:
+    try:
+        sel, n = page.evaluate(_FIRST_CARD_SELECTOR_JS, CARD_SELECTORS)
+        return sel, int(n or 0)
+    except Exception:
+        for sel in CARD_SELECTORS:
+            n = page.locator(sel).count()
+            if n > 0:
+                return sel, n
+        return None, 0
+
 def _wait_any_cards(page, timeout_ms=30000, tag="") -> Tuple[str, int]:
     end = time.time() + timeout_ms/1000
     last = None
+    # модалки закрывает init-script; страховочный проход — один раз, а не на каждой итерации
+    _dismiss(page)
     while time.time() < end:
-        _dismiss(page)
-        for sel in CARD_SELECTORS:
-            try:
-                page.wait_for_selector(sel, state="attached", timeout=1200)
-                cnt = page.locator(sel).count()
-                if cnt > 0:
-                    return sel, cnt
-            except Exception as e:
-                last = e
+        # Один wait_for на объединённый селектор: браузер сам сообщит, как только появится любая карточка
+        left_ms = int(max(0.0, end - time.time()) * 1000)
+        try:
+            page.locator(_CARD_SEL_UNION).first.wait_for(state="attached", timeout=max(1000, min(left_ms, 5000)))
+            sel, cnt = _first_card_selector(page)
+            if sel:
+                return sel, cnt
+        except Exception as e:
+            last = e
         try:
             page.evaluate("window.scrollBy(0, Math.max(300, document.body.scrollHeight * 0.5))")
         except Exception:
             pass
-        time.sleep(0.7)
     raise last or PWTimeout(f"Нет карточек ({tag})")
 
-def _extract_products_on_page(page) -> List[Product]:
-    base = None
-    for sel in CARD_SELECTORS:
-        if page.locator(sel).count() > 0:
-            base = sel
-            break
+# Один page.evaluate вместо 5-8 CDP-запросов на каждую карточку.
+# only — список data-product-id: сериализуем только эти карточки (дельта после дозагрузки)
+_EXTRACT_CARDS_JS = """
+({selectors, only}) => {
+  let cards = [];
+  for (const sel of selectors) {
+    cards = document.querySelectorAll(sel);
+    if (cards.length) break;
+  }
+  const want = only ? new Set(only) : null;
+  const out = [];
+  for (const el of cards) {
+    if (want && !want.has(el.getAttribute('data-product-id'))) continue;
+    const t = el.querySelector('a[title], a[data-product-name], .item-card__name, [itemprop="name"]');
+    const a = el.querySelector('a[href*="/shop/p/"], a[itemprop="url"]');
+    const m = el.querySelector('[itemprop="price"]');
+    const pr = el.querySelector('[data-test="price"], .item-card__prices, .item-card__price');
+    out.push({
+      pid: el.getAttribute('data-product-id'),
+      title: t ? (t.innerText || '').trim() : null,
+      href: a ? a.getAttribute('href') : null,
+      price_content: m ? m.getAttribute('content') : null,
+      price_text: pr ? pr.innerText : null,
+    });
+  }
+  return out;
+}
+"""
+
+_VISIBLE_IDS_JS = """
+() => Array.from(document.querySelectorAll('article[data-product-id], [data-product-id]'))
+          .map(e => e.getAttribute('data-product-id')).filter(Boolean)
+"""
+
+def _extract_products_on_page(page, only_ids: Optional[Set[str]] = None) -> List[Product]:
+    """Карточки текущей страницы; only_ids — только карточки с этими data-product-id
+    (например, появившиеся после «Показать ещё»/скролла), без повторного разбора уже собранных."""
+    only = list(only_ids) if only_ids is not None else None
+    try:
+        raw = page.evaluate(_EXTRACT_CARDS_JS, {"selectors": CARD_SELECTORS, "only": only})
+    except Exception as e:
+        logger.debug("evaluate карточек не сработал (%s) — fallback на локаторы", e)
+        found = _extract_products_on_page_locators(page)
+        if only_ids is not None:
+            found = [it for it in found if it.product_id in only_ids]
+        return found
+    out: List[Product] = []
+    for d in raw or []:
+        title = d.get("title")
+        if not title:
+            continue
+        href = d.get("href")
+        if href and href[0] == "/":
+            href = KASPI_ORIGIN + href
+        lp = _regex_price_to_float(d.get("price_content"))
+        if lp is None:
+            lp = _regex_price_to_float(d.get("price_text"))
+        out.append(Product(product_id=d.get("pid"), title=title, url=href, list_price=lp))
+    return out
+
+def _extract_products_on_page_locators(page) -> List[Product]:
+    base, n = _first_card_selector(page)
     if not base:
         return []
     cards = page.locator(base)
-    n = cards.count()
     out: List[Product] = []
     for i in range(n):
         el = cards.nth(i)
@@ -165,8 +761,8 @@ def _extract_products_on_page(page) -> List[Product]:
             link = el.locator('a[href*="/shop/p/"], a[itemprop="url"]')
             if link.count():
                 href = link.first.get_attribute("href")
-                if href and href.startswith("/"):
-                    href = "https://kaspi.kz" + href
+                if href and href[0] == "/":
+                    href = KASPI_ORIGIN + href
         except Exception:
             pass
         try:
@@ -186,6 +782,10 @@ def _extract_products_on_page(page) -> List[Product]:
     return out
 
 def _collect_visible_ids(page) -> Set[str]:
+    try:
+        return set(page.evaluate(_VISIBLE_IDS_JS) or [])
+    except Exception:
+        pass
     ids = set()
     try:
         loc = page.locator('article[data-product-id], [data-product-id]')
@@ -197,6 +797,95 @@ def _collect_visible_ids(page) -> Set[str]:
         pass
     return ids
 
+# Пауза между запросами пагинации: delay + случайные 0.05–0.2 с
+_JITTER_LO = 0.05
+_JITTER_SPAN = 0.15
+
+def _jitter_sleep(delay: float) -> None:
+    time.sleep(delay + _JITTER_LO + _JITTER_SPAN * random.random())
+
+def _poll_until(predicate: Callable[[], bool], timeout: float, initial: float = 0.05,
+                factor: float = 1.5, cap: float = 0.8, sleep: Callable[[float], None] = time.sleep) -> bool:
+    """Опрос predicate с растущим интервалом (initial → cap) до timeout секунд.
+    Для ожиданий, зависящих от событий Playwright, передавайте sleep=_pw_sleep(page):
+    sync-API обрабатывает события только внутри своих вызовов, time.sleep их не прокачивает.
+    """
+    deadline = time.time() + timeout
+    interval = initial
+    while True:
+        if predicate():
+            return True
+        left = deadline - time.time()
+        if left <= 0:
+            return False
+        sleep(min(interval, left))
+        interval = min(interval * factor, cap)
+
+def _pw_sleep(page) -> Callable[[float], None]:
+    return lambda sec: page.wait_for_timeout(sec * 1000)
+
+def _listing_xhr_sleep(page) -> Callable[[float], None]:
+    """«Сон» для _poll_until, который просыпается сразу по завершении XHR листинга.
+    threading.Event тут не годится: sync-Playwright вызывает обработчики в этом же потоке
+    и только внутри своих вызовов, поэтому ждём само событие requestfinished."""
+    def _sleep(sec: float) -> None:
+        try:
+            page.wait_for_event(
+                "requestfinished",
+                predicate=lambda r: any(part in r.url for part in XHR_CAPTURE_URL_PARTS),
+                timeout=max(1.0, sec * 1000),
+            )
+        except Exception:
+            pass
+    return _sleep
+
+# Весь цикл «скролл → ждать роста ленты» внутри страницы: один round-trip вместо пары на шаг
+_SCROLL_UNTIL_STABLE_JS = """
+async ({ sel, waitMs, maxSteps }) => {
+  const size = () => document.querySelectorAll(sel).length;
+  for (let i = 0; i < maxSteps; i++) {
+    const n0 = size(), h0 = document.body.scrollHeight;
+    window.scrollBy(0, Math.max(400, h0 * 0.85));
+    const end = Date.now() + waitMs;
+    let grown = false;
+    while (Date.now() < end) {
+      await new Promise(r => setTimeout(r, 100));
+      if (size() > n0 || document.body.scrollHeight > h0) { grown = true; break; }
+    }
+    if (!grown) { return i; }
+  }
+  return maxSteps;
+}
+"""
+
+def _scroll_until_stable(page, delay: float, max_steps: int = 12, ids: Optional[Set[str]] = None) -> Set[str]:
+    """Докручивает ленивую ленту: после каждого скролла ждёт новых карточек до delay сек,
+    и останавливается, как только очередной скролл ничего не подгрузил.
+    ids — уже снятый снимок видимых id (чтобы не снимать его повторно); возвращает последний снимок."""
+    wait_ms = int(max(delay, 0.5) * 1000)
+    try:
+        page.evaluate(_SCROLL_UNTIL_STABLE_JS, {"sel": _CARD_SEL_UNION, "waitMs": wait_ms, "maxSteps": max_steps})
+        return _collect_visible_ids(page)
+    except Exception:
+        pass
+    # фолбэк (навигация посреди скролла и т.п.) — тот же цикл из Python
+    seen = _collect_visible_ids(page) if ids is None else ids
+    for _ in range(max_steps):
+        try:
+            page.evaluate("window.scrollBy(0, Math.max(400, document.body.scrollHeight * 0.85))")
+        except Exception:
+            pass
+        box = [seen]
+
+        def _grown() -> bool:
+            box[0] = _collect_visible_ids(page)
+            return not box[0] <= seen
+
+        if not _poll_until(_grown, timeout=max(delay, 0.5)):
+            break
+        seen = box[0]
+    return seen
+
 # ---------------------- XHR capture & pagination inference ----------------------
 def _is_json_like(headers: Dict[str, str]) -> bool:
     ct = (headers or {}).get("content-type", "") or ""
@@ -204,61 +893,120 @@ def _is_json_like(headers: Dict[str, str]) -> bool:
 
 SAVE_DUMPS = bool(int(os.getenv("KASPI_SAVE_DUMPS", "0")))
 
-def _save_dump(prefix: str, payload: dict, ext: str = "json") -> str:
+# Запись дампов — в фоновом потоке: сериализация и диск не тормозят обработчики событий Playwright.
+# Пишем NDJSON, по одному файлу на префикс (logs/xhr_resp.ndjson и т.д.), пачками до DUMP_BATCH записей / 1 с.
+_DUMP_QUEUE: "queue.Queue[Tuple[str, Dict[str, Any]]]" = queue.Queue()
+_dump_thread: Optional[threading.Thread] = None
+_dump_lock = threading.Lock()
+DUMP_BATCH = 32
+
+def _write_dumps(batch: List[Tuple[str, Dict[str, Any]]]) -> None:
+    by_path: Dict[str, List[bytes]] = {}
+    for path, record in batch:
+        try:
+            by_path.setdefault(path, []).append(_json_dumpb(record))
+        except Exception as e:
+            logger.debug("save dump failed: %s", e)
+    for path, lines in by_path.items():
+        try:
+            with open(path, "ab") as f:
+                f.write(b"\n".join(lines) + b"\n")
+            logger.debug("Дампы дописаны: %s (+%s)", path, len(lines))
+        except Exception as e:
+            logger.debug("save dump failed: %s", e)
+
+def _dump_worker() -> None:
+    while True:
+        batch = [_DUMP_QUEUE.get()]
+        deadline = time.time() + 1.0
+        while len(batch) < DUMP_BATCH:
+            left = deadline - time.time()
+            if left <= 0:
+                break
+            try:
+                batch.append(_DUMP_QUEUE.get(timeout=left))
+            except queue.Empty:
+                break
+        try:
+            _write_dumps(batch)
+        finally:
+            for _ in batch:
+                _DUMP_QUEUE.task_done()
+
+def _flush_dumps() -> None:
+    """Дожидается записи всех поставленных в очередь дампов."""
+    if _dump_thread is not None:
+        _DUMP_QUEUE.join()
+
+atexit.register(_flush_dumps)
+
+def _save_dump(prefix: str, payload: dict) -> str:
+    global _dump_thread
     if not SAVE_DUMPS:
         return ""
     _ensure_dir("logs")
-    ts = int(time.time() * 1000)
-    path = os.path.join("logs", f"{prefix}_{ts}.{ext}")
-    try:
-        with open(path, "w", encoding="utf-8") as f:
-            if ext == "json":
-                json.dump(payload, f, ensure_ascii=False, indent=2)
-            else:
-                f.write(str(payload))
-        logger.info("Лог сохранён: %s", path)
-    except Exception as e:
-        logger.debug("save dump failed: %s", e)
+    path = os.path.join("logs", f"{prefix}.ndjson")
+    if _dump_thread is None:
+        with _dump_lock:
+            if _dump_thread is None:
+                _dump_thread = threading.Thread(target=_dump_worker, name="kaspi-dumps", daemon=True)
+                _dump_thread.start()
+    _DUMP_QUEUE.put_nowait((path, {"ts": int(time.time() * 1000), **payload}))
     return path
 
+def _dump_follow(url: str, data: Any) -> None:
+    """Пара дампов xhr_follow_req/resp для GET пагинации; без --save-dumps payload даже не собираем."""
+    if not SAVE_DUMPS:
+        return
+    _save_dump("xhr_follow_req", {"method": "GET", "url": url, "body": ""})
+    _save_dump("xhr_follow_resp", {"url": url, "data": data})
+
+# В on_request_finished разбираем только JSON эндпоинтов выдачи/карточек; остальное (трекеры, конфиги) — мимо
+XHR_CAPTURE_URL_PARTS = ("/pl/filters", "/pl/results", "/product-view", "graphql")
+# Ответы больше лимита не парсим (content-length), по умолчанию 4 МБ
+XHR_MAX_BYTES = int(os.getenv("KASPI_XHR_MAX_BYTES", str(4 * 1024 * 1024)))
+
+_ITEM_KEYS = ("cards", "items", "products", "results", "list", "edges", "nodes")
+_CURSOR_KEYS = ("next", "nextPage", "next_page", "nextToken", "next_token", "cursor", "after")
+_PAGE_INFO_KEYS = ("pageInfo", "pagination", "meta", "paging")
+_PAGE_INFO_CURSOR_KEYS = ("next", "cursor", "endCursor", "after")
+_PAGE_INFO_META_KEYS = ("page", "pageNumber", "p", "offset", "start", "from", "limit", "size", "rows", "perPage")
+
 def _infer_array_and_next(data: dict) -> Tuple[Optional[List[dict]], Dict[str, Optional[str]]]:
     """Возвращает (items, hints), где hints может содержать cursor/has_next/meta."""
     if not isinstance(data, (dict, list)):
         return None, {}
-    def _scan(obj):
+    # Итеративный обход в глубину без рекурсии; дети кладутся в обратном порядке,
+    # чтобы порядок проверки (и первый найденный массив) совпадал с прежним рекурсивным вариантом
+    stack = [data]
+    while stack:
+        obj = stack.pop()
         if isinstance(obj, list):
-            for x in obj:
-                arr, hints = _scan(x)
-                if arr:
-                    return arr, hints
-            return None, {}
-        if isinstance(obj, dict):
-            for key in ("cards", "items", "products", "results", "list", "edges", "nodes"):
-                if isinstance(obj.get(key), list) and obj.get(key):
-                    hints: Dict[str, Optional[str]] = {}
-                    for k in ("next", "nextPage", "next_page", "nextToken", "next_token", "cursor", "after"):
-                        if obj.get(k):
-                            hints["cursor"] = str(obj.get(k))
-                    for mk in ("pageInfo", "pagination", "meta", "paging"):
-                        if isinstance(obj.get(mk), dict):
-                            pi = obj[mk]
-                            # Встречается множество ложных hasNextPage=false в нерелевантных блоках (например, фильтрах),
-                            # поэтому здесь НЕ используем это как стоп-сигнал. Считаем наличие следующей страницы
-                            # отдельно по limit/total в XHR-потоке.
-                            for p in ("next", "cursor", "endCursor", "after"):
-                                if pi.get(p):
-                                    hints["cursor"] = str(pi[p])
-                            for p in ("page","pageNumber","p","offset","start","from","limit","size","rows","perPage"):
-                                if p in pi:
-                                    hints.setdefault("meta", {})
-                                    hints["meta"][p] = pi[p]
-                    return obj[key], hints
-            for v in obj.values():
-                arr, hints = _scan(v)
-                if arr:
-                    return arr, hints
-        return None, {}
-    return _scan(data)
+            stack.extend(x for x in reversed(obj) if isinstance(x, (dict, list)))
+            continue
+        for key in _ITEM_KEYS:
+            arr = obj.get(key)
+            if isinstance(arr, list) and arr:
+                hints: Dict[str, Optional[str]] = {}
+                for k in _CURSOR_KEYS:
+                    if obj.get(k):
+                        hints["cursor"] = str(obj.get(k))
+                for mk in _PAGE_INFO_KEYS:
+                    pi = obj.get(mk)
+                    if isinstance(pi, dict):
+                        # Встречается множество ложных hasNextPage=false в нерелевантных блоках (например, фильтрах),
+                        # поэтому здесь НЕ используем это как стоп-сигнал. Считаем наличие следующей страницы
+                        # отдельно по limit/total в XHR-потоке.
+                        for p in _PAGE_INFO_CURSOR_KEYS:
+                            if pi.get(p):
+                                hints["cursor"] = str(pi[p])
+                        for p in _PAGE_INFO_META_KEYS:
+                            if p in pi:
+                                hints.setdefault("meta", {})
+                                hints["meta"][p] = pi[p]
+                return arr, hints
+        stack.extend(v for v in reversed(list(obj.values())) if isinstance(v, (dict, list)))
+    return None, {}
 
 def _bump_query_params(url: str, step: int = 12) -> Optional[str]:
     pr = urlparse(url)
@@ -279,17 +1027,39 @@ def _bump_query_params(url: str, step: int = 12) -> Optional[str]:
     new_q = urlencode({k: v[0] for k,v in qs.items()}, doseq=False)
     return urlunparse((pr.scheme, pr.netloc, pr.path, pr.params, new_q, pr.fragment))
 
+# page=N — единственное, что меняется между XHR листинга; его вырезаем до кэширования разбора
+_PAGE_PARAM_RE = re.compile(r"([?&])page=(\d+)(&?)")
+
+@lru_cache(maxsize=256)
+def _parse_xhr_query(url_wo_page: str) -> Tuple[str, Tuple[Tuple[str, str], ...]]:
+    parsed = urlparse(url_wo_page)
+    qs = parse_qs(parsed.query)
+    return parsed.path, tuple((k, v[0] if v else "") for k, v in qs.items() if k != "page")
+
+def _split_xhr_url(url: str) -> Tuple[str, Optional[int], Dict[str, str]]:
+    """(path, page, прочие query-параметры первым значением) для URL перехваченного XHR."""
+    page_no = None
+    m = _PAGE_PARAM_RE.search(url)
+    if m:
+        page_no = int(m.group(2))
+        url = url[:m.start()] + (m.group(1) if m.group(3) else "") + url[m.end():]
+    path, items = _parse_xhr_query(url)
+    return path, page_no, dict(items)
+
+@lru_cache(maxsize=256)
 def _strip_zone_in_q(url: str) -> str:
     """Удаляет :availableInZones:... из q=, чтобы не резало пагинацию."""
-    pr = urlparse(url)
-    qs = parse_qs(pr.query)
+    # подстрока переживает и %3A-кодирование — без неё разбирать URL незачем
+    if "availableInZones" not in url:
+        return url
+    (scheme, netloc, path, params, _query, fragment), qs = _parse_url_qs(url)
     if "q" in qs and qs["q"]:
         q = qs["q"][0]
-        q2 = re.sub(r":availableInZones:[A-Za-z0-9_\-]+", "", q)
+        q2 = _ZONE_RE.sub("", q)
         if q2 != q:
             qs["q"] = [q2]
             new_q = urlencode({k: v[0] for k, v in qs.items()})
-            url = urlunparse((pr.scheme, pr.netloc, pr.path, pr.params, new_q, pr.fragment))
+            url = urlunparse((scheme, netloc, path, params, new_q, fragment))
     return url
 
 def _extract_request_id_from_data(data: Any) -> Optional[str]:
@@ -305,7 +1075,7 @@ def _extract_request_id_from_data(data: Any) -> Optional[str]:
 def _bump_graphql_body(body_str: str, hints: Dict[str, Optional[str]], step: int = 12) -> Optional[str]:
     """Пробуем инкрементировать variables.page/offset/start или подставить cursor/after."""
     try:
-        body = json.loads(body_str) if body_str else {}
+        body = _json_loads(body_str) if body_str else {}
     except Exception:
         return None
     def _mut(op):
@@ -335,14 +1105,141 @@ def _bump_graphql_body(body_str: str, hints: Dict[str, Optional[str]], step: int
         if _mut(body): changed = True
     if not changed and isinstance(body, dict) and "variables" in body and isinstance(body["variables"], dict) and hints.get("cursor"):
         body["variables"]["after"] = hints["cursor"]; changed = True
-    return json.dumps(body, ensure_ascii=False) if changed else None
+    return _json_dumps(body) if changed else None
 
 # ---------------------- Detail meta ----------------------
+def _ld_product_meta(meta: Dict[str, Optional[float]], data) -> bool:
+    """Заполняет meta из одного JSON-LD блока; True, если в нём нашёлся Product."""
+    if isinstance(data, list):
+        for obj in data:
+            if isinstance(obj, dict) and obj.get("@type") == "Product":
+                prod = obj
+                break
+        else:
+            prod = None
+    elif isinstance(data, dict) and data.get("@type") == "Product":
+        prod = data
+    else:
+        prod = None
+    if not prod:
+        return False
+
+    # rating / reviews
+    agg = prod.get("aggregateRating") or {}
+    r = agg.get("ratingValue")
+    c = agg.get("reviewCount") or agg.get("ratingCount")
+    if r is not None:
+        try:
+            meta["rating"] = float(str(r).replace(",", "."))
+        except Exception:
+            pass
+    if c is not None:
+        try:
+            meta["reviews"] = int(str(c).translate(_INT_TRANS))
+        except Exception:
+            pass
+
+    # offers
+    offers = prod.get("offers")
+    if isinstance(offers, dict):
+        # AggregateOffer
+        low = offers.get("lowPrice") or offers.get("price")
+        if low is not None:
+            try:
+                meta["price_min"] = float(str(low).translate(_PRICE_TRANS))
+            except Exception:
+                pass
+        if offers.get("offerCount") is not None:
+            try:
+                meta["offers_count"] = int(offers["offerCount"])
+            except Exception:
+                pass
+    elif isinstance(offers, list) and offers:
+        try:
+            meta["price_default"] = _regex_price_to_float(offers[0].get("price")) or meta["price_default"]
+        except Exception:
+            pass
+
+    # Иногда JSON-LD хранит и единственную "price"
+    if meta["price_default"] is None:
+        p = prod.get("price")
+        if p is not None:
+            meta["price_default"] = _regex_price_to_float(str(p))
+    return True
+
+# Всё, что нужно _parse_product_meta, собирается одним page.evaluate: сырые строки JSON-LD,
+# itemprop-меты и тексты кандидатов отзывов/рейтинга; разбор — теми же Python-парсерами.
+_PRODUCT_META_JS = """
+() => {
+  const txt = (el) => (el.innerText || '').trim();
+  const pick = (sel, filter) => {
+    let els = [];
+    try { els = Array.from(document.querySelectorAll(sel)); } catch (e) { return []; }
+    return filter ? els.filter(filter) : els;
+  };
+  const hasText = (needle) => (el) => (el.textContent || '').toLowerCase().includes(needle);
+  const meta = (sel) => { const m = document.querySelector(sel); return m ? m.getAttribute('content') : null; };
+
+  const reviewGroups = [
+    pick('[data-testid*="review"], [class*="review"]'),
+    pick('span', hasText('отзыв')),
+    pick('span[itemprop="reviewCount"], [itemprop="reviewCount"]'),
+  ].map(g => g.map(txt));
+
+  const ratingGroups = [
+    pick('[data-rating]'),
+    pick('[aria-label*="из 5"]'),
+    pick('span[title*="из 5"]'),
+    pick('[class*="rating"]'),
+    pick('span[itemprop="ratingValue"], [itemprop="ratingValue"]'),
+  ].map(g => g.map(el => [el.getAttribute('data-rating'),
+                          el.getAttribute('title') || el.getAttribute('aria-label'),
+                          txt(el)]));
+
+  // аналог text=/^\\s*от\\s+.+/i: самые вложенные элементы с текстом «от <цена>».
+  // Обходим текстовые узлы, а не все элементы: textContent читаем только у родителя узла,
+  // начинающегося с «от», — без textContent контейнеров уровня body на каждой карточке
+  const reOt = /^\\s*от\\s+.+/i;
+  const reOtStart = /^\\s*от(\\s|$)/i;
+  const otTexts = [];
+  const seenOt = new Set();
+  if (document.body) {
+    const walker = document.createTreeWalker(document.body, NodeFilter.SHOW_TEXT, {
+      acceptNode: (n) => reOtStart.test(n.data) ? NodeFilter.FILTER_ACCEPT : NodeFilter.FILTER_SKIP,
+    });
+    for (let n = walker.nextNode(); n; n = walker.nextNode()) {
+      const el = n.parentElement;
+      if (!el || seenOt.has(el)) continue;
+      seenOt.add(el);
+      const t = (el.textContent || '');
+      if (t.length > 120 || !reOt.test(t)) continue;
+      if (Array.from(el.children).some(ch => reOt.test(ch.textContent || ''))) continue;
+      otTexts.push(txt(el));
+    }
+  }
+
+  return {
+    ld: Array.from(document.querySelectorAll('script[type="application/ld+json"]')).map(s => s.textContent || ''),
+    rating_meta: meta('meta[itemprop="ratingValue"]'),
+    reviews_meta: meta('meta[itemprop="reviewCount"], meta[itemprop="ratingCount"]'),
+    review_groups: reviewGroups,
+    rating_groups: ratingGroups,
+    ot_texts: otTexts,
+  };
+}
+"""
+
 def _parse_product_meta(page) -> Dict[str, Optional[float]]:
     """Возвращает метаданные товара с карточки:
     { rating, reviews, price_min, price_default, offers_count }
     Использует JSON-LD (AggregateOffer/Offer) + запасные HTML-селекторы.
     """
+    try:
+        raw = page.evaluate(_PRODUCT_META_JS)
+    except Exception as e:
+        logger.debug("evaluate меты товара не сработал (%s) — fallback на локаторы", e)
+        return _parse_product_meta_locators(page)
+
     meta: Dict[str, Optional[float]] = {
         "rating": None,
         "reviews": None,
@@ -351,72 +1248,92 @@ def _parse_product_meta(page) -> Dict[str, Optional[float]]:
         "offers_count": None,
     }
 
-    # 1) JSON-LD (наиболее надёжный источник для lowPrice/offerCount)
+    # 1) JSON-LD
+    for body in raw.get("ld") or []:
+        try:
+            data = _json_loads(body)
+        except Exception:
+            continue
+        if _ld_product_meta(meta, data):
+            break
+
+    # 2) Запасные селекторы для отзывов/рейтинга
     try:
-        scripts = page.locator('script[type="application/ld+json"]').all()
-        for sc in scripts:
+        v = raw.get("rating_meta")
+        if v:
+            meta["rating"] = float(str(v).replace(',', '.'))
+        v = raw.get("reviews_meta")
+        if v:
+            meta["reviews"] = int(_NONDIGIT_RE.sub("", v))
+    except Exception:
+        pass
+
+    if not meta["reviews"]:
+        for group in raw.get("review_groups") or []:
+            for text in group:
+                m = _REVIEWS_RE.search(text or "")
+                if not m:
+                    m = _REVIEWS_PAREN_RE.search(text or "")
+                if m:
+                    meta["reviews"] = int(m.group(1))
+                    break
+            if meta["reviews"]:
+                break
+
+    if not meta["rating"]:
+        for group in raw.get("rating_groups") or []:
             try:
-                data = json.loads(sc.inner_text(timeout=2000))
-            except Exception:
-                continue
-            if isinstance(data, list):
-                for obj in data:
-                    if isinstance(obj, dict) and obj.get("@type") == "Product":
-                        prod = obj
+                for val, title_attr, text in group:
+                    if val:
+                        meta["rating"] = float(val)
                         break
-                else:
-                    prod = None
-            elif isinstance(data, dict) and data.get("@type") == "Product":
-                prod = data
-            else:
-                prod = None
-            if not prod:
+                    if title_attr and 'из 5' in title_attr:
+                        m = _RATING_RE.search(title_attr)
+                        if m:
+                            meta["rating"] = float(m.group(1).replace(',', '.'))
+                            break
+                    if text and 'из 5' in text:
+                        m = _RATING_RE.search(text)
+                        if m:
+                            meta["rating"] = float(m.group(1).replace(',', '.'))
+                            break
+            except Exception:
                 continue
+            if meta["rating"]:
+                break
 
-            # rating / reviews
-            agg = prod.get("aggregateRating") or {}
-            r = agg.get("ratingValue")
-            c = agg.get("reviewCount") or agg.get("ratingCount")
-            if r is not None:
-                try:
-                    meta["rating"] = float(str(r).replace(",", "."))
-                except Exception:
-                    pass
-            if c is not None:
-                try:
-                    meta["reviews"] = int(str(c).replace(" ", ""))
-                except Exception:
-                    pass
+    # 3) Минимальная цена по тексту "от <цена>"
+    if meta.get("price_min") is None:
+        for t in raw.get("ot_texts") or []:
+            if t.lower().startswith('от'):
+                val = _regex_price_to_float(t)
+                if val:
+                    meta["price_min"] = val
+                    break
 
-            # offers
-            offers = prod.get("offers")
-            if isinstance(offers, dict):
-                # AggregateOffer
-                low = offers.get("lowPrice") or offers.get("price")
-                if low is not None:
-                    try:
-                        meta["price_min"] = float(str(low).replace(",", ".").replace(" ", ""))
-                    except Exception:
-                        pass
-                if offers.get("offerCount") is not None:
-                    try:
-                        meta["offers_count"] = int(offers["offerCount"])
-                    except Exception:
-                        pass
-            elif isinstance(offers, list) and offers:
-                try:
-                    meta["price_default"] = _regex_price_to_float(offers[0].get("price")) or meta["price_default"]
-                except Exception:
-                    pass
+    return meta
 
-            # Иногда JSON-LD хранит и единственную "price"
-            if meta["price_default"] is None:
-                p = prod.get("price")
-                if p is not None:
-                    meta["price_default"] = _regex_price_to_float(str(p))
+def _parse_product_meta_locators(page) -> Dict[str, Optional[float]]:
+    """Прежний вариант _parse_product_meta на локаторах (много CDP round-trip'ов) — фолбэк."""
+    meta: Dict[str, Optional[float]] = {
+        "rating": None,
+        "reviews": None,
+        "price_min": None,
+        "price_default": None,
+        "offers_count": None,
+    }
 
+    # 1) JSON-LD (наиболее надёжный источник для lowPrice/offerCount)
+    try:
+        scripts = page.locator('script[type="application/ld+json"]').all()
+        for sc in scripts:
+            try:
+                data = _json_loads(sc.inner_text(timeout=2000))
+            except Exception:
+                continue
             # Прерываем после первого подходящего Product
-            break
+            if _ld_product_meta(meta, data):
+                break
     except Exception:
         pass
 
@@ -433,7 +1350,7 @@ def _parse_product_meta(page) -> Dict[str, Optional[float]]:
             if rc_meta.count():
                 v = rc_meta.get_attribute('content')
                 if v:
-                    meta["reviews"] = int(re.sub(r"\D+", "", v))
+                    meta["reviews"] = int(_NONDIGIT_RE.sub("", v))
         except Exception:
             pass
 
@@ -451,9 +1368,9 @@ def _parse_product_meta(page) -> Dict[str, Optional[float]]:
                     elements = page.locator(selector).all()
                     for element in elements:
                         text = (element.inner_text(timeout=800) or "").strip()
-                        m = re.search(r"(\d+)[^\d]*отзыв", text, flags=re.I)
+                        m = _REVIEWS_RE.search(text)
                         if not m:
-                            m = re.search(r"\((\d+)\)", text)
+                            m = _REVIEWS_PAREN_RE.search(text)
                         if m:
                             meta["reviews"] = int(m.group(1))
                             break
@@ -481,13 +1398,13 @@ def _parse_product_meta(page) -> Dict[str, Optional[float]]:
                             break
                         title_attr = element.get_attribute('title') or element.get_attribute('aria-label')
                         if title_attr and 'из 5' in title_attr:
-                            m = re.search(r"(\d+(?:[\.,]\d+)?)\s*из\s*5", title_attr)
+                            m = _RATING_RE.search(title_attr)
                             if m:
                                 meta["rating"] = float(m.group(1).replace(',', '.'))
                                 break
                         text = (element.inner_text(timeout=800) or "").strip()
                         if 'из 5' in text:
-                            m = re.search(r"(\d+(?:[\.,]\d+)?)\s*из\s*5", text)
+                            m = _RATING_RE.search(text)
                             if m:
                                 meta["rating"] = float(m.group(1).replace(',', '.'))
                                 break
@@ -518,73 +1435,174 @@ def _parse_product_meta(page) -> Dict[str, Optional[float]]:
 
     return meta
 
-def _enrich_detail_min_price_and_meta(context, items: List[Product], limit:int=24, delay:float=0.6) -> List[Product]:
-    if not items:
-        return items
-    page = context.new_page()
-    for it in items[:limit]:
-        if not it.url:
+# Узлы, по которым видно, что detail-страница отрисовала данные для _parse_product_meta
+_DETAIL_READY_SEL = 'script[type="application/ld+json"], [itemprop="price"]'
+
+# Быстрый путь без рендера: JSON-LD и itemprop=price прямо из HTML карточки (GET через httpx)
+DETAIL_HTTP = bool(int(os.getenv("KASPI_DETAIL_HTTP", "1")))
+_LD_JSON_RE = re.compile(rb'<script[^>]*application/ld\+json[^>]*>(.*?)</script>', re.S | re.I)
+# Тег с itemprop=price целиком, content из него — отдельно: порядок атрибутов в вёрстке не фиксирован
+_ITEMPROP_PRICE_TAG_RE = re.compile(rb'<[^>]*\bitemprop=["\']price["\'][^>]*>', re.I)
+_CONTENT_ATTR_RE = re.compile(rb'\bcontent=["\']([^"\']+)', re.I)
+# Базовые заголовки; user-agent контекста и referer листинга докладывает вызывающий —
+# у httpx-клиента своих нет, и без них kaspi видит python-httpx и чаще отвечает 403
+_DETAIL_HTML_HEADERS = {
+    "accept": "text/html,application/xhtml+xml;q=0.9,*/*;q=0.8",
+    "accept-language": "ru-RU,ru;q=0.9,en-US;q=0.8",
+}
+
+def _detail_meta_from_html(body: bytes) -> Optional[Dict[str, Optional[float]]]:
+    """Мета товара из сырого HTML по JSON-LD; None, если Product в JSON-LD нет (тогда нужен рендер)."""
+    meta: Dict[str, Optional[float]] = {
+        "rating": None,
+        "reviews": None,
+        "price_min": None,
+        "price_default": None,
+        "offers_count": None,
+    }
+    for block in _LD_JSON_RE.findall(body or b""):
+        try:
+            data = _json_loads(block.strip())
+        except Exception:
             continue
+        if _ld_product_meta(meta, data):
+            return meta
+    return None
+
+def _apply_meta_fields(it: Product, meta: Dict[str, Optional[float]]) -> None:
+    # Рейтинг/отзывы
+    it.rating = it.rating or meta.get("rating")
+    it.reviews = it.reviews or (meta.get("reviews") if isinstance(meta.get("reviews"), (int, float)) else None)
+    # min/default корректируем
+    if meta.get("price_min") is not None:
+        it.price_min = meta["price_min"]
+    if meta.get("price_default") is not None:
+        it.price_default = meta["price_default"]
+    # Фолбэк: если ничего не нашли — используем list_price
+    if it.list_price is not None:
+        it.price_default = it.price_default or it.list_price
+        it.price_min = it.price_min or it.list_price
+
+def _apply_detail_html(body: bytes, it: Product) -> bool:
+    """Дополняет товар из HTML карточки; False — в JSON-LD не хватает рейтинга или числа отзывов:
+    карточку надо открыть в браузере (там есть DOM-фолбэки для рейтинга/отзывов и видимой цены)."""
+    meta = _detail_meta_from_html(body)
+    if meta is None or meta.get("rating") is None or meta.get("reviews") is None:
+        return False
+    if it.list_price is None:
+        tag = _ITEMPROP_PRICE_TAG_RE.search(body)
+        m = _CONTENT_ATTR_RE.search(tag.group(0)) if tag else None
+        if m:
+            it.list_price = _regex_price_to_float(m.group(1).decode("utf-8", "ignore"))
+        if it.list_price is None:
+            # видимую цену без рендера не достать — пусть решает браузерный путь
+            return False
+    _apply_meta_fields(it, meta)
+    return True
+
+def _apply_detail_meta(page, it: Product) -> None:
+    """Дополняет товар данными с уже открытой карточки (рейтинг, отзывы, цены)."""
+    meta = _parse_product_meta(page)
+
+    # Цена по источникам приоритета: JSON-LD lowPrice -> [itemprop=price] -> видимая цена
+    if it.list_price is None:
+        # список/отображаемая
+        try:
+            meta_price = page.locator('[itemprop="price"]').first
+            content_val = meta_price.get_attribute("content") if meta_price.count() else None
+            val = _regex_price_to_float(content_val) if content_val else None
+            if val is None:
+                ptext = page.locator('[data-test="price"], .price__value, [class*="price"]').first.inner_text(timeout=2500)
+                val = _regex_price_to_float(ptext)
+            it.list_price = val
+        except Exception:
+            pass
+
+    _apply_meta_fields(it, meta)
+
+def _mark_detail_fail(it: Product) -> None:
+    it.errors = (it.errors + "; " if it.errors else "") + "detail_visit_fail"
+
+# Сколько карточек товара грузим одновременно (вкладки одного контекста)
+DETAIL_CONCURRENCY = max(1, int(os.getenv("KASPI_DETAIL_CONCURRENCY", "8") or 1))
+
+def _enrich_detail_min_price_and_meta(context, items: List[Product], limit:int=24,
+                                      api: Optional["_ApiClient"] = None,
+                                      http_headers: Optional[Dict[str, str]] = None) -> List[Product]:
+    """Дозаполняет цены/рейтинг/продавцов с карточек товара: до DETAIL_CONCURRENCY вкладок одновременно.
+    Темп задаёт размер пула вкладок, фиксированной паузы между товарами нет.
+    С api (и KASPI_DETAIL_HTTP=1) сначала тянем HTML карточек параллельным GET и разбираем JSON-LD;
+    в браузере открываем только те, где его не оказалось (челлендж, другая вёрстка).
+    http_headers — поверх _DETAIL_HTML_HEADERS (user-agent контекста, referer)."""
+    todo = [it for it in items[:limit] if it.url]
+    if todo and api is not None and DETAIL_HTTP:
         try:
-            page.goto(it.url, wait_until="domcontentloaded")
-            _dismiss(page)
+            headers = {**_DETAIL_HTML_HEADERS, **(http_headers or {})}
+            responses = api.get_many([it.url for it in todo], timeout=20000, headers=headers,
+                                     workers=DETAIL_CONCURRENCY, json_only=False)
+        except Exception as e:
+            logger.debug("HTTP-детали не удались (%s) — все карточки через браузер", e)
+            responses = [None] * len(todo)
+        rest: List[Product] = []
+        for it, r in zip(todo, responses):
             try:
-                page.wait_for_load_state("networkidle", timeout=8000)
+                if r is not None and r.ok and _apply_detail_html(r.body(), it):
+                    continue
             except Exception:
                 pass
-            meta = _parse_product_meta(page)
-            # Рейтинг/отзывы
-            it.rating = it.rating or meta.get("rating")
-            it.reviews = it.reviews or (meta.get("reviews") if isinstance(meta.get("reviews"), (int, float)) else None)
-
-            # Цена по источникам приоритета: JSON-LD lowPrice -> [itemprop=price] -> видимая цена
-            price_min = meta.get("price_min")
-            price_default = meta.get("price_default")
+            rest.append(it)
+        logger.info("Детали по HTTP: %s из %s, в браузере: %s", len(todo) - len(rest), len(todo), len(rest))
+        todo = rest
+    if not todo:
+        return items
+    # Sync API не даёт await-ить несколько goto и не работает из потоков, поэтому конвейер вкладок:
+    # в каждой стартуем навигацию (ждём только commit ответа), затем по очереди дожидаемся DOM
+    # самой старой; освободившаяся вкладка сразу берёт следующий товар, не дожидаясь остальных.
+    pending = deque(todo)
+    inflight: deque = deque()
+
+    def _start(page) -> None:
+        while pending:
+            it = pending.popleft()
+            try:
+                page.goto(it.url, wait_until="commit")
+                inflight.append((page, it))
+                return
+            except Exception:
+                _mark_detail_fail(it)
 
-            if it.list_price is None:
-                # список/отображаемая
+    pool = [context.new_page() for _ in range(min(DETAIL_CONCURRENCY, len(todo)))]
+    try:
+        for page in pool:
+            _start(page)
+        while inflight:
+            page, it = inflight.popleft()
+            try:
+                page.wait_for_load_state("domcontentloaded")
+                # networkidle на kaspi часто не наступает из-за трекеров — ждём сам узел с данными
                 try:
-                    meta_price = page.locator('[itemprop="price"]').first
-                    content_val = meta_price.get_attribute("content") if meta_price.count() else None
-                    val = _regex_price_to_float(content_val) if content_val else None
-                    if val is None:
-                        ptext = page.locator('[data-test="price"], .price__value, [class*="price"]').first.inner_text(timeout=2500)
-                        val = _regex_price_to_float(ptext)
-                    it.list_price = val
+                    page.wait_for_selector(_DETAIL_READY_SEL, state="attached", timeout=4000)
                 except Exception:
                     pass
-
-            # min/default корректируем
-            if price_min is not None:
-                it.price_min = price_min
-            if price_default is not None:
-                it.price_default = price_default
-            # Фолбэк: если ничего не нашли — используем list_price
-            if it.list_price is not None:
-                it.price_default = it.price_default or it.list_price
-                it.price_min = it.price_min or it.list_price
-
-        except Exception:
-            it.errors = (it.errors + "; " if it.errors else "") + "detail_visit_fail"
-    page.close()
+                _apply_detail_meta(page, it)
+            except Exception:
+                _mark_detail_fail(it)
+            _start(page)
+    finally:
+        for page in pool:
+            try:
+                page.close()
+            except Exception:
+                pass
     return items
 
 # ---------------------- UI pagination fallback by ?page=N ----------------------
-def _paginate_by_page_param(page, base_url: str, start_page: int, pages: int, delay: float) -> List[Product]:
-    """Простая HTML пагинация по параметру ?page=N для категорий.
-    Возвращает собранные с дополнительных страниц карточки.
-    """
-    added: List[Product] = []
-    from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
+# Сколько ?page=N грузим одновременно (вкладки одного контекста); 1 — строго по очереди
+PAGE_PARAM_CONCURRENCY = max(1, int(os.getenv("KASPI_PAGE_CONCURRENCY", "3") or 1))
 
-    pr = urlparse(base_url)
-    base_qs = parse_qs(pr.query)
-
-    for pg in range(start_page, max(start_page, pages) + 1):
-        qs = dict((k, v[0] if isinstance(v, list) else v) for k, v in base_qs.items())
-        qs["page"] = str(pg)
-        new_q = urlencode(qs)
-        url = urlunparse((pr.scheme, pr.netloc, pr.path, pr.params, new_q, pr.fragment))
+def _paginate_urls_sequential(page, urls: List[str], delay: float) -> List[Product]:
+    added: List[Product] = []
+    for url in urls:
         try:
             if not _open_listing_try(page, url):
                 break
@@ -597,10 +1615,77 @@ def _paginate_by_page_param(page, base_url: str, start_page: int, pages: int, de
             break
     return added
 
+def _paginate_urls_windowed(page, urls: List[str], delay: float,
+                            tab_hook: Optional[Callable[[Any], None]] = None) -> List[Product]:
+    """Окно вкладок: во всех стартуем goto (до commit), затем по порядку ждём карточки.
+    Останавливаемся на первой пустой/неоткрывшейся странице, как и последовательный вариант;
+    на 429 доделываем остаток по очереди с паузой.
+    """
+    added: List[Product] = []
+    extra = []
+    try:
+        for _ in range(min(PAGE_PARAM_CONCURRENCY, len(urls)) - 1):
+            t = page.context.new_page()
+            if tab_hook:
+                tab_hook(t)
+            extra.append(t)
+        tabs = [page] + extra
+        i = 0
+        while i < len(urls):
+            window = list(zip(tabs, urls[i:i + len(tabs)]))
+            started = []
+            for tab, url in window:
+                try:
+                    started.append((tab, url, tab.goto(url, wait_until="commit")))
+                except Exception:
+                    break
+            for n, (tab, url, resp) in enumerate(started):
+                if resp is not None and resp.status == 429:
+                    logger.info("?page=N: HTTP 429 — дальше по одной странице с паузой.")
+                    time.sleep(delay * 2)
+                    return added + _paginate_urls_sequential(page, urls[i + n:], delay * 2)
+                try:
+                    tab.wait_for_load_state("domcontentloaded")
+                    _wait_any_cards(tab, timeout_ms=20000, tag="page")
+                    b = _extract_products_on_page(tab)
+                except Exception:
+                    b = []
+                if not b:
+                    return added
+                added.extend(b)
+            if len(started) < len(window):
+                break
+            i += len(window)
+            _jitter_sleep(delay)
+    finally:
+        for t in extra:
+            try:
+                t.close()
+            except Exception:
+                pass
+    return added
+
+def _paginate_by_page_param(page, base_url: str, start_page: int, pages: int, delay: float,
+                            tab_hook: Optional[Callable[[Any], None]] = None) -> List[Product]:
+    """Простая HTML пагинация по параметру ?page=N для категорий.
+    Возвращает собранные с дополнительных страниц карточки.
+    tab_hook вызывается для каждой дополнительной вкладки (например, повесить XHR-обработчик).
+    """
+    # URL разбираем один раз, в цикле меняется только page
+    pr = urlparse(base_url)
+    qs = {k: v[0] for k, v in parse_qs(pr.query).items()}
+    urls = []
+    for pg in range(start_page, max(start_page, pages) + 1):
+        qs["page"] = str(pg)
+        urls.append(urlunparse((pr.scheme, pr.netloc, pr.path, pr.params, urlencode(qs), pr.fragment)))
+
+    if PAGE_PARAM_CONCURRENCY > 1 and len(urls) > 1:
+        return _paginate_urls_windowed(page, urls, delay, tab_hook)
+    return _paginate_urls_sequential(page, urls, delay)
+
 # ---------------------- helpers: city/zone param ----------------------
 def _add_query_param(url: str, key: str, value: str) -> str:
     try:
-        from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
         pr = urlparse(url)
         qs = parse_qs(pr.query)
         qs[key] = [value]
@@ -610,16 +1695,38 @@ def _add_query_param(url: str, key: str, value: str) -> str:
         sep = '&' if ('?' in url) else '?'
         return f"{url}{sep}{key}={value}"
 
+# В XHR-пагинации одни и те же базовые URL разбираются десятки раз за раунд — кэшируем разбор.
+# Результат неизменяемый: вызывающие копируют query в свой dict.
+@lru_cache(maxsize=512)
+def _parse_url_cached(url: str) -> Tuple[Tuple[str, str, str, str, str, str], Tuple[Tuple[str, Tuple[str, ...]], ...]]:
+    pr = urlparse(url)
+    return tuple(pr), tuple((k, tuple(v)) for k, v in parse_qs(pr.query).items())
+
+def _parse_url_qs(url: str) -> Tuple[Tuple[str, str, str, str, str, str], Dict[str, List[str]]]:
+    parts, qs = _parse_url_cached(url)
+    return parts, {k: list(v) for k, v in qs}
+
+# Параметры позиции в выдаче, которые offset-пагинация выставляет сама
+_OFFSET_PAGING_KEYS = ("offset", "start", "from", "page", "p", "pageNumber", "page_num", "i")
+
+@lru_cache(maxsize=512)
+def _strip_query_params(url: str, keys: Tuple[str, ...]) -> str:
+    """URL без указанных query-параметров (остальные — первым значением)."""
+    try:
+        (scheme, netloc, path, params, _query, fragment), qs = _parse_url_qs(url)
+        new_q = urlencode({k: v[0] for k, v in qs.items() if k not in keys and v})
+        return urlunparse((scheme, netloc, path, params, new_q, fragment))
+    except Exception:
+        return url
+
 def _set_query_params(url: str, kv: Dict[str, str]) -> str:
     """Устанавливает/заменяет несколько query-параметров в URL."""
     try:
-        from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
-        pr = urlparse(url)
-        qs = parse_qs(pr.query)
+        (scheme, netloc, path, params, _query, fragment), qs = _parse_url_qs(url)
         for k, v in kv.items():
             qs[k] = [v]
         new_q = urlencode({k: v[0] if isinstance(v, list) and v else v for k, v in qs.items()})
-        return urlunparse((pr.scheme, pr.netloc, pr.path, pr.params, new_q, pr.fragment))
+        return urlunparse((scheme, netloc, path, params, new_q, fragment))
     except Exception:
         # Фолбэк: по одному ключу, иначе вернём исходный url
         try:
@@ -628,9 +1735,18 @@ def _set_query_params(url: str, kv: Dict[str, str]) -> str:
         except Exception:
             return url
 
+def _append_query(base: str, kv: Dict[str, str]) -> str:
+    """Дописывает kv к URL, из которого эти ключи уже вычищены (_strip_query_params).
+    Результат тот же, что у _set_query_params, но без разбора/сборки базы на каждый вариант."""
+    if "#" in base:
+        return _set_query_params(base, kv)
+    if not kv:
+        return base
+    sep = "&" if "?" in base else "?"
+    return f"{base}{sep}{urlencode(kv)}"
+
 def _detect_c_param(page) -> Optional[str]:
     try:
-        from urllib.parse import urlparse, parse_qs
         # 1) Пытаемся взять из текущего URL
         try:
             cur = page.url
@@ -679,10 +1795,6 @@ def _paginate_by_nav_next(page, pages: int, delay: float) -> List[Product]:
             page.wait_for_load_state("domcontentloaded")
         except Exception:
             pass
-        try:
-            page.wait_for_load_state("networkidle", timeout=8000)
-        except Exception:
-            pass
         # ждём смену набора карточек
         changed = _wait_items_changed(page, prev_ids, timeout_ms=12000)
         if not changed:
@@ -713,7 +1825,7 @@ def _paginate_by_nav_numbers(page, pages: int, delay: float) -> List[Product]:
                 text = (loc.nth(i).inner_text(timeout=500) or '').strip()
             except Exception:
                 continue
-            if re.fullmatch(r"\d+", text):
+            if _DIGITS_RE.fullmatch(text):
                 try:
                     val = int(text)
                 except Exception:
@@ -741,10 +1853,6 @@ def _paginate_by_nav_numbers(page, pages: int, delay: float) -> List[Product]:
             page.wait_for_load_state("domcontentloaded")
         except Exception:
             pass
-        try:
-            page.wait_for_load_state("networkidle", timeout=8000)
-        except Exception:
-            pass
         if not _wait_items_changed(page, current_ids, timeout_ms=12000):
             current_ids = _collect_visible_ids(page)
             continue
@@ -758,48 +1866,94 @@ def _paginate_by_nav_numbers(page, pages: int, delay: float) -> List[Product]:
         time.sleep(delay)
     return added
 
+def _paginate_all_strategies(page, base_url: str, pages: int, delay: float,
+                             tab_hook: Optional[Callable[[Any], None]] = None,
+                             known_ids: Optional[Set[str]] = None) -> List[Product]:
+    """HTML-пагинация: ?page=N, затем «Следующая», затем номера — до первой стратегии, давшей новые ID.
+    known_ids — уже собранные product_id (стр. 1 и т.п.): если kaspi игнорирует ?page=N и отдаёт
+    первую страницу, такие «успехи» не считаются, и пробуем следующую стратегию.
+    Возвращает карточки без повторов по product_id (объединение всех пройденных стратегий)."""
+    strategies = (
+        lambda: _paginate_by_page_param(page, base_url, start_page=2, pages=pages, delay=delay, tab_hook=tab_hook),
+        lambda: _paginate_by_nav_next(page, pages=pages, delay=delay),
+        lambda: _paginate_by_nav_numbers(page, pages=pages, delay=delay),
+    )
+    seen: Set[str] = set(known_ids or ())
+    out: List[Product] = []
+    for run in strategies:
+        try:
+            found = run()
+        except Exception:
+            found = []
+        new_ids = 0
+        for it in found:
+            if it.product_id:
+                if it.product_id in seen:
+                    continue
+                seen.add(it.product_id)
+                new_ids += 1
+            out.append(it)
+        if new_ids:
+            break
+    return out
+
 # ---------------------- Human-like interaction helpers ----------------------
-def _click_text_node(page, keywords: List[str], selectors: Optional[List[str]] = None) -> bool:
+# Поиск и клик по узлу с текстом: один querySelectorAll по объединённому селектору (порядок документа),
+# ключевые слова приводятся к нижнему регистру один раз. Из вложенных совпадений берём самое внутреннее —
+# иначе на широких селекторах (div) первым совпадает огромный контейнер.
+_CLICK_TEXT_DEFAULT_SEL = 'button, a, label, span, li, div'
+_CLICK_TEXT_NODE_JS = r"""
+({ keywords, selector }) => {
+    const lowered = Array.from(new Set((keywords || []).map(k => (k || '').trim().toLowerCase()).filter(Boolean)));
+    if (!lowered.length) { return false; }
+    let list;
+    try { list = document.querySelectorAll(selector); } catch (e) { return false; }
+    const matches = (node) => {
+        const text = (node.textContent || '').replace(/\s+/g, ' ').trim().toLowerCase();
+        if (!text) { return false; }
+        for (let k = 0; k < lowered.length; k++) { if (text.includes(lowered[k])) { return true; } }
+        return false;
+    };
+    let best = null;
+    for (let i = 0; i < list.length; i++) {
+        const node = list[i];
+        if (!(node instanceof HTMLElement)) { continue; }
+        if (best && !best.contains(node)) { break; }
+        if (matches(node)) { best = node; }
+    }
+    if (!best) { return false; }
+    try { best.scrollIntoView({ block: 'center', behavior: 'smooth' }); } catch (e) {}
+    best.dispatchEvent(new Event('mouseenter', { bubbles: true }));
+    best.dispatchEvent(new Event('mouseover', { bubbles: true }));
+    best.click();
+    return true;
+}
+"""
+
+@lru_cache(maxsize=256)
+def _lowered_keywords(keywords: Tuple[str, ...]) -> Tuple[str, ...]:
+    return tuple(kw.lower().strip() for kw in keywords if kw and kw.strip())
+
+@lru_cache(maxsize=64)
+def _joined_selector(selectors: Tuple[str, ...]) -> str:
+    return ", ".join(selectors) or _CLICK_TEXT_DEFAULT_SEL
+
+_FILTER_GROUP_KWS = ("производитель", "производители", "бренд", "бренды")
+_FILTER_GROUP_SEL = ("button", '[role="button"]')
+_BRAND_OPTION_SEL = ("label", "span", "li", "button")
+_BRAND_OPTION_FALLBACK_SEL = ("label", "span", "li", "div")
+
+def _click_text_node(page, keywords: Iterable[str], selectors: Optional[Iterable[str]] = None) -> bool:
     if not keywords:
         return False
-    lowered = [kw.lower().strip() for kw in keywords if kw and kw.strip()]
+    lowered = _lowered_keywords(tuple(keywords))
     if not lowered:
         return False
-    payload = {"keywords": lowered, "selectors": selectors or []}
+    payload = {"keywords": list(lowered), "selector": _joined_selector(tuple(selectors or ()))}
     try:
         return bool(
             page.evaluate(
-                r"""
-                ({ keywords, selectors }) => {
-                    const lowered = (keywords || []).map(k => (k || '').trim().toLowerCase()).filter(Boolean);
-                    if (!lowered.length) { return false; }
-                    let nodes = [];
-                    if (selectors && selectors.length) {
-                        for (const sel of selectors) {
-                            try {
-                                nodes = nodes.concat(Array.from(document.querySelectorAll(sel)));
-                            } catch (e) {}
-                        }
-                    } else {
-                        nodes = Array.from(document.querySelectorAll('button, a, label, span, li, div'));
-                    }
-                    for (const node of nodes) {
-                        if (!(node instanceof HTMLElement)) { continue; }
-                        const text = (node.textContent || '').replace(/\s+/g, ' ').trim().toLowerCase();
-                        if (!text) { continue; }
-                        for (const kw of lowered) {
-                            if (text.includes(kw)) {
-                                try { node.scrollIntoView({ block: 'center', behavior: 'smooth' }); } catch (e) {}
-                                node.dispatchEvent(new Event('mouseenter', { bubbles: true }));
-                                node.dispatchEvent(new Event('mouseover', { bubbles: true }));
-                                node.click();
-                                return true;
-                            }
-                        }
-                    }
-                    return false;
-                }
-                """,
+                _CLICK_TEXT_NODE_JS,
                 payload,
             )
         )
@@ -812,11 +1966,11 @@ def _apply_brand_filter_ui(page, brand: str, delay: float) -> bool:
     if not brand:
         return False
     try:
-        _click_text_node(page, ["производитель", "производители", "бренд", "бренды"], ["button", "[role=\"button\"]"])
+        _click_text_node(page, _FILTER_GROUP_KWS, _FILTER_GROUP_SEL)
     except Exception:
         pass
     time.sleep(0.4)
-    if _click_text_node(page, [brand], ["label", "span", "li", "button"]):
+    if _click_text_node(page, (brand,), _BRAND_OPTION_SEL):
         time.sleep(delay)
         return True
     try:
@@ -844,50 +1998,49 @@ def _apply_brand_filter_ui(page, brand: str, delay: float) -> bool:
         typed = False
     if typed:
         time.sleep(0.4)
-        if _click_text_node(page, [brand], ["label", "span", "li", "button"]):
+        if _click_text_node(page, (brand,), _BRAND_OPTION_SEL):
             time.sleep(delay)
             return True
-    try:
-        success = page.evaluate(
-            r"""
-            (brand) => {
-                const lower = (brand || '').toLowerCase();
-                if (!lower) { return false; }
-                const nodes = Array.from(document.querySelectorAll('label, span, li, div'));
-                for (const node of nodes) {
-                    if (!(node instanceof HTMLElement)) { continue; }
-                    const text = (node.textContent || '').replace(/\s+/g, ' ').trim().toLowerCase();
-                    if (!text) { continue; }
-                    if (text.includes(lower)) {
-                        node.click();
-                        return true;
-                    }
-                }
-                return false;
-            }
-            """,
-            brand,
-        )
-    except Exception:
-        success = False
+    # последний шанс: самый вложенный label/span/li/div с названием бренда
+    success = _click_text_node(page, (brand,), _BRAND_OPTION_FALLBACK_SEL)
     if success:
         time.sleep(delay)
     return bool(success)
 
 
+_ACTIVE_PAGE_SELECTORS = [
+    '.pagination__el._active',
+    'nav a[aria-current="page"]',
+    'nav li._active',
+    'nav a[aria-label="Текущая страница"]',
+]
+# Все селекторы активной страницы за один evaluate; [data-page] берём из атрибута, остальные — по тексту
+_ACTIVE_PAGE_JS = r"""
+(sels) => {
+    for (const s of sels) {
+        const e = document.querySelector(s);
+        if (!e) { continue; }
+        const t = (e.innerText || e.textContent || '').trim();
+        if (/^\d+$/.test(t)) { return +t; }
+    }
+    const dp = document.querySelector('[data-page].is-active');
+    const t = dp ? (dp.getAttribute('data-page') || '').trim() : '';
+    return /^\d+$/.test(t) ? +t : null;
+}
+"""
+
 def _detect_active_page_number(page) -> Optional[int]:
-    selectors = [
-        '.pagination__el._active',
-        'nav a[aria-current="page"]',
-        'nav li._active',
-        'nav a[aria-label="Текущая страница"]',
-    ]
-    for sel in selectors:
+    try:
+        n = page.evaluate(_ACTIVE_PAGE_JS, _ACTIVE_PAGE_SELECTORS)
+        return int(n) if n is not None else None
+    except Exception:
+        pass
+    for sel in _ACTIVE_PAGE_SELECTORS:
         try:
             loc = page.locator(sel).first
             if loc.count():
                 text = (loc.inner_text(timeout=1000) or "").strip()
-                if re.fullmatch(r"\d+", text):
+                if _DIGITS_RE.fullmatch(text):
                     return int(text)
         except Exception:
             continue
@@ -902,11 +2055,63 @@ def _detect_active_page_number(page) -> Optional[int]:
     return None
 
 
+@contextmanager
+def _pl_quiet(page, path: str = "/pl/"):
+    """Считает запросы к API выдачи (path) в полёте; отдаёт wait(quiet_ms, timeout_ms),
+    которое ждёт, пока они не стихнут на quiet_ms. Вместо networkidle, который на kaspi
+    из-за сторонних маяков часто не наступает до таймаута.
+    """
+    inflight: Set[Any] = set()
+
+    def _on_request(r):
+        if path in r.url:
+            inflight.add(r)
+
+    def _on_done(r):
+        inflight.discard(r)
+
+    page.on("request", _on_request)
+    page.on("requestfinished", _on_done)
+    page.on("requestfailed", _on_done)
+
+    def wait(quiet_ms: int = 400, timeout_ms: int = 8000) -> bool:
+        end = time.time() + timeout_ms / 1000
+        quiet_since = None
+        while time.time() < end:
+            if inflight:
+                quiet_since = None
+            elif quiet_since is None:
+                quiet_since = time.time()
+            elif (time.time() - quiet_since) * 1000 >= quiet_ms:
+                return True
+            page.wait_for_timeout(50)
+        return False
+
+    try:
+        yield wait
+    finally:
+        for ev, cb in (("request", _on_request), ("requestfinished", _on_done), ("requestfailed", _on_done)):
+            try:
+                page.remove_listener(ev, cb)
+            except Exception:
+                pass
+
+# href + scroll + hover за один round-trip; сам клик — настоящий, через _safe_click
+_NAV_PREPARE_JS = """
+(el) => {
+    const href = el.getAttribute('href') || el.getAttribute('data-href');
+    try { el.scrollIntoView({ block: 'center' }); } catch (e) {}
+    el.dispatchEvent(new MouseEvent('mouseover', { bubbles: true }));
+    el.dispatchEvent(new MouseEvent('mouseenter', { bubbles: true }));
+    return href;
+}
+"""
+
 def _simulate_human_pagination(
     page,
     pages: int,
     delay: float,
-    upsert_cb: Callable[[Product], bool],
+    upsert_many_cb: Callable[[Iterable[Product]], int],
     captured_ids: Set[str],
     get_items_len: Callable[[], int],
     max_items: int,
@@ -932,36 +2137,25 @@ def _simulate_human_pagination(
         prev_ids = _collect_visible_ids(page)
         prev_url = page.url
         prev_active = _detect_active_page_number(page)
-        target_href = None
-        try:
-            target_href = nav.get_attribute("href") or nav.get_attribute("data-href")
-        except Exception:
-            target_href = None
-        try:
-            nav.scroll_into_view_if_needed(timeout=2000)
-        except Exception:
-            pass
-        try:
-            nav.hover(timeout=1000)
-        except Exception:
-            pass
-        if not _safe_click(nav):
-            break
-        try:
-            page.wait_for_load_state("domcontentloaded")
-        except Exception:
-            pass
-        try:
-            page.wait_for_response(
-                lambda r: "product-view/pl/filters" in r.url and r.status == 200,
-                timeout=15000,
-            )
-        except Exception:
-            pass
-        try:
-            page.wait_for_load_state("networkidle", timeout=12000)
-        except Exception:
-            pass
+        with _pl_quiet(page) as wait_pl_quiet:
+            try:
+                target_href = nav.evaluate(_NAV_PREPARE_JS)
+            except Exception:
+                target_href = None
+            if not _safe_click(nav):
+                break
+            try:
+                page.wait_for_load_state("domcontentloaded")
+            except Exception:
+                pass
+            try:
+                page.wait_for_response(
+                    lambda r: "product-view/pl/filters" in r.url and r.ok,
+                    timeout=8000,
+                )
+            except Exception:
+                pass
+            wait_pl_quiet()
         changed = _wait_items_changed(page, prev_ids, timeout_ms=15000)
         if not changed:
             try:
@@ -978,15 +2172,17 @@ def _simulate_human_pagination(
         if not changed and target_href:
             try:
                 if target_href.startswith("/"):
-                    target_href_full = "https://kaspi.kz" + target_href
+                    target_href_full = KASPI_ORIGIN + target_href
                 else:
                     target_href_full = target_href
                 logger.info("Human режим: прямой переход по %s", target_href_full)
-                page.goto(target_href_full, wait_until="domcontentloaded")
-                try:
-                    page.wait_for_load_state("networkidle", timeout=12000)
-                except Exception:
-                    pass
+                with _pl_quiet(page) as wait_pl_quiet:
+                    page.goto(target_href_full, wait_until="domcontentloaded")
+                    try:
+                        page.wait_for_selector(_CARD_SEL_UNION, state="visible", timeout=20000)
+                    except Exception:
+                        pass
+                    wait_pl_quiet()
                 changed = True
             except Exception:
                 pass
@@ -1002,16 +2198,10 @@ def _simulate_human_pagination(
             continue
         consecutive_empty = 0
         cards = _extract_products_on_page(page)
-        snapshot_ids = []
-        for it in cards:
-            if it.product_id:
-                snapshot_ids.append(it.product_id)
-        new_added = 0
-        for it in cards:
-            if upsert_cb(it):
-                new_added += 1
-            if it.product_id:
-                captured_ids.add(it.product_id)
+        snapshot_ids = [it.product_id for it in cards if it.product_id]
+        # вся страница — одним апсертом; колбэк возвращает число новых карточек
+        new_added = upsert_many_cb(cards)
+        captured_ids.update(snapshot_ids)
         added_total += new_added
         detected = _detect_active_page_number(page)
         current_page = detected or (current_page + 1)
@@ -1025,7 +2215,7 @@ def _simulate_human_pagination(
         )
         if get_items_len() >= max_items:
             break
-        time.sleep(delay + random.uniform(0.05, 0.2))
+        _jitter_sleep(delay)
         if attempts > pages * 2:
             break
     return added_total
@@ -1034,30 +2224,86 @@ def _simulate_human_pagination(
 def _open_listing_try(page, url: str) -> bool:
     logger.info("Открываю листинг: %s", url)
     page.goto(url, wait_until="domcontentloaded")
-    _dismiss(page)
-    try:
-        page.wait_for_load_state("networkidle", timeout=8000)
-    except Exception:
-        pass
+    # готовность = появились карточки; networkidle не ждём, страховочный _dismiss делает _wait_any_cards
     try:
         _wait_any_cards(page, timeout_ms=20000, tag="entry")
         return True
     except Exception:
         return False
 
-def _pagination_exists(page) -> bool:
-    selectors = [
-        'nav a:has-text("2")',
-        'nav a[aria-label="Следующая"]',
-        'nav a:has-text("Следующая")',
-        'a[rel="next"]',
-        '.pagination a[rel="next"]',
-        '.pagination__el:has-text("2")',
-        '.pagination__el:has-text("Следующая")',
+# Правила пагинации как (css, текст): текст — аналог Playwright :has-text (подстрока без учёта регистра).
+# Поиск по всем правилам идёт одним page.evaluate вместо count()/get_attribute на каждый локатор.
+_PAGINATION_EXISTS_RULES = [
+    ('nav a', '2'),
+    ('nav a[aria-label="Следующая"]', None),
+    ('nav a', 'Следующая'),
+    ('a[rel="next"]', None),
+    ('.pagination a[rel="next"]', None),
+    ('.pagination__el', '2'),
+    ('.pagination__el', 'Следующая'),
+]
+
+_PAGINATION_FIND_JS = r"""
+({ rules, allowDisabled, allowActive, mark }) => {
+    const norm = (t) => (t || '').replace(/\s+/g, ' ').trim().toLowerCase();
+    for (const [css, text] of rules) {
+        let el = null;
+        let list;
+        try { list = document.querySelectorAll(css); } catch (e) { continue; }
+        const needle = text ? norm(text) : null;
+        for (let i = 0; i < list.length; i++) {
+            if (!needle || norm(list[i].textContent).includes(needle)) { el = list[i]; break; }
+        }
+        if (!el) { continue; }
+        if (!mark) { return true; }
+        const cls = el.getAttribute('class') || '';
+        if (!allowDisabled && cls.includes('_disabled')) { continue; }
+        if (!allowActive && cls.includes('_active')) { continue; }
+        const inner = el.querySelector('a, button');
+        if (inner) { el = inner; }
+        const handle = 'pg-' + Date.now().toString(36) + Math.random().toString(36).slice(2, 8);
+        el.setAttribute('data-pg-handle', handle);
+        return handle;
+    }
+    return mark ? null : false;
+}
+"""
+
+@lru_cache(maxsize=64)
+def _pagination_rules(label: str) -> Tuple[Tuple[str, Optional[str]], ...]:
+    # набор правил зависит только от метки — строим один раз на метку
+    rules: List[Tuple[str, Optional[str]]] = [
+        ('nav a', label),
+        ('nav[aria-label="Pagination"] a', label),
+        ('.pagination__el', label),
+        ('.pagination li', label),
+        ('button', label),
+        ('[role="button"]', label),
+        (f'button[data-page="{label}"]', None),
+        (f'[data-page="{label}"]', None),
     ]
-    for sel in selectors:
+    if label.lower() in {"следующая", "дальше"}:
+        rules.extend([
+            ('a[rel="next"]', None),
+            ('button[aria-label*="Следующая"]', None),
+            ('[data-test="pagination-next"]', None),
+            ('button.pagination__el', "Следующая"),
+        ])
+    return tuple(rules)
+
+def _rule_to_pw_selector(css: str, text: Optional[str]) -> str:
+    return f'{css}:has-text("{text}")' if text else css
+
+def _pagination_exists(page) -> bool:
+    try:
+        return bool(page.evaluate(_PAGINATION_FIND_JS, {
+            "rules": _PAGINATION_EXISTS_RULES, "allowDisabled": True, "allowActive": True, "mark": False,
+        }))
+    except Exception:
+        pass
+    for css, text in _PAGINATION_EXISTS_RULES:
         try:
-            if page.locator(sel).first.count():
+            if page.locator(_rule_to_pw_selector(css, text)).first.count():
                 return True
         except Exception:
             continue
@@ -1065,25 +2311,16 @@ def _pagination_exists(page) -> bool:
 
 
 def _find_pagination_element(page, label: str, *, allow_disabled: bool = False, allow_active: bool = False):
-    selectors = [
-        f'nav a:has-text("{label}")',
-        f'nav[aria-label="Pagination"] a:has-text("{label}")',
-        f'.pagination__el:has-text("{label}")',
-        f'.pagination li:has-text("{label}")',
-        f'button:has-text("{label}")',
-        f'[role="button"]:has-text("{label}")',
-        f'button[data-page="{label}"]',
-        f'[data-page="{label}"]',
-    ]
-    if label.lower() in {"следующая", "дальше"}:
-        selectors.extend([
-            'a[rel="next"]',
-            'button[aria-label*="Следующая"]',
-            '[data-test="pagination-next"]',
-            'button.pagination__el:has-text("Следующая")',
-        ])
-    for sel in selectors:
-        loc = page.locator(sel).first
+    rules = _pagination_rules(label)
+    try:
+        handle = page.evaluate(_PAGINATION_FIND_JS, {
+            "rules": list(rules), "allowDisabled": allow_disabled, "allowActive": allow_active, "mark": True,
+        })
+        return page.locator(f'[data-pg-handle="{handle}"]') if handle else None
+    except Exception:
+        pass
+    for css, text in rules:
+        loc = page.locator(_rule_to_pw_selector(css, text)).first
         if not loc.count():
             continue
         try:
@@ -1104,46 +2341,48 @@ def _find_pagination_element(page, label: str, *, allow_disabled: bool = False,
     return None
 
 
+# Клик по самому элементу или его первому интерактивному потомку — один round-trip
+_SAFE_CLICK_JS = """
+(el) => {
+    const sel = 'a, button, [role="button"]';
+    const t = el.matches(sel) ? el : (el.querySelector(sel) || el);
+    t.click();
+    return true;
+}
+"""
+
+# Ошибки клика, после которых клик уже мог сработать (ушли на другую страницу) — повторять нельзя
+_NAV_ERROR_MARKERS = ("navigat", "context was destroyed", "target closed", "has been closed")
+
+def _is_nav_error(e: Exception) -> bool:
+    msg = str(e).lower()
+    return any(m in msg for m in _NAV_ERROR_MARKERS)
+
 def _safe_click(locator) -> bool:
     if not locator or not locator.count():
         return False
+    # основной путь — настоящий (isTrusted) клик мышью с проверками Playwright
     try:
-        locator.click()
-        return True
-    except Exception:
-        pass
-    try:
-        locator.evaluate("el => el.click()")
-        return True
-    except Exception:
-        pass
-    try:
-        handle = locator.element_handle(timeout=500)
-        if handle:
-            handle.click()
-            return True
-    except Exception:
-        pass
-    try:
-        inner = locator.locator("a, button").first
-        if inner.count():
-            inner.click()
+        locator.click(timeout=5000)
+        return True
+    except Exception as e:
+        if _is_nav_error(e):
+            # клик начал навигацию — второй клик увёл бы дальше
             return True
-    except Exception:
-        pass
-    return False
+    # фолбэк — JS-клик одним evaluate (перекрыт оверлеем, не прошёл actionability и т.п.)
+    try:
+        return bool(locator.evaluate(_SAFE_CLICK_JS, timeout=2000))
+    except Exception as e:
+        return _is_nav_error(e)
 
-def _click_load_more_until_stop(page, max_clicks:int=30, delay:float=0.7) -> None:
+def _click_load_more_until_stop(page, max_clicks:int=30, delay:float=0.7, ids: Optional[Set[str]] = None) -> Set[str]:
+    """Жмёт «Показать ещё», пока лента растёт. ids — снимок видимых id до старта (если уже снят);
+    возвращает снимок после последнего роста — его же берёт следующий шаг вместо повторного вызова."""
     clicks = 0
+    before = _collect_visible_ids(page) if ids is None else ids
     while clicks < max_clicks:
-        before = _collect_visible_ids(page)
-        btn = None
-        for sel in ALL_LOAD_MORE_SELECTORS:
-            loc = page.locator(sel).first
-            if loc.count():
-                btn = loc
-                break
-        if not btn:
+        btn = page.locator(_LOAD_MORE_COMBINED).first
+        if not btn.count():
             break
         try:
             btn.click()
@@ -1155,18 +2394,61 @@ def _click_load_more_until_stop(page, max_clicks:int=30, delay:float=0.7) -> Non
             except Exception:
                 break
         page.wait_for_load_state("domcontentloaded")
-        try:
-            page.wait_for_load_state("networkidle", timeout=8000)
-        except Exception:
-            pass
         changed = _wait_items_changed(page, before, timeout_ms=10000)
         time.sleep(delay)
         clicks += 1
         if not changed:
             break
+        before = _collect_visible_ids(page)
+    return before
+
+# Счётчик мутаций DOM (ставится init-script'ом на контекст): пока он не менялся,
+# проверка в _wait_items_changed не трогает DOM вовсе, а набор id сравнивается только после мутаций.
+_IDS_OBSERVER_JS = """
+(() => {
+  window.__kaspiIdsGen = 0;
+  const start = () => {
+    new MutationObserver(() => { window.__kaspiIdsGen++; })
+      .observe(document.documentElement, { subtree: true, childList: true,
+                                           attributes: true, attributeFilter: ['data-product-id'] });
+  };
+  if (document.documentElement) start();
+  else document.addEventListener('readystatechange', start, { once: true });
+})();
+"""
+
+_ITEMS_CHANGED_JS = """
+({ prev, token }) => {
+  const gen = window.__kaspiIdsGen;
+  if (gen !== undefined) {
+    const seen = window.__kaspiIdsSeen;
+    if (seen && seen.token === token && seen.gen === gen) return false;
+    window.__kaspiIdsSeen = { token, gen };
+  }
+  const ids = Array.from(document.querySelectorAll('article[data-product-id], [data-product-id]'),
+                         e => e.getAttribute('data-product-id')).filter(Boolean);
+  if (!ids.length) return false;
+  const before = new Set(prev);
+  const cur = new Set(ids);
+  if (cur.size !== before.size) return true;
+  for (const id of cur) if (!before.has(id)) return true;
+  return false;
+}
+"""
 
 def _wait_items_changed(page, prev_ids: Set[str], timeout_ms=12000) -> bool:
     end = time.time() + timeout_ms/1000
+    try:
+        page.evaluate("window.scrollTo(0,0)")
+        token = f"{time.time():.6f}-{random.random():.6f}"
+        page.wait_for_function(_ITEMS_CHANGED_JS, arg={"prev": list(prev_ids), "token": token},
+                               timeout=timeout_ms, polling=100)
+        return True
+    except PWTimeout:
+        return False
+    except Exception:
+        # контекст пересоздан навигацией и т.п. — добираем остаток времени опросом
+        pass
     while time.time() < end:
         ids = _collect_visible_ids(page)
         if ids and ids != prev_ids:
@@ -1178,72 +2460,196 @@ def _wait_items_changed(page, prev_ids: Set[str], timeout_ms=12000) -> bool:
         time.sleep(0.4)
     return False
 
+# Сколько брендов смартфонов обходить одновременно (у каждого свой playwright/браузер в отдельном потоке);
+# 1 (по умолчанию) — по очереди на основной вкладке, как раньше
+BRAND_CONCURRENCY = max(1, int(os.getenv("KASPI_BRAND_CONCURRENCY", "1") or 1))
+# Лимит на процесс: вложенные пулы (бренды запроса, фильтры брендов, бакеты batch_runner) делят одни и те же
+# BRAND_CONCURRENCY слотов под дополнительные браузеры. Берём без ожидания — кому не досталось, идёт по очереди
+_brand_slots = threading.Semaphore(BRAND_CONCURRENCY)
+
+def _take_brand_slots(n: int) -> int:
+    got = 0
+    while got < n and _brand_slots.acquire(blocking=False):
+        got += 1
+    return got
+
+def _give_brand_slots(n: int) -> None:
+    for _ in range(n):
+        _brand_slots.release()
+
+def _brand_pass(page, entry_url: str, brand: str, c_param: Optional[str], sort: str, pages: int, delay: float,
+                tab_hook: Optional[Callable[[Any], None]] = None) -> Optional[List[Product]]:
+    """Один проход листинга для бренда: вход, фильтр бренда, «Показать ещё»/скролл, HTML-пагинация.
+    Возвращает все собранные карточки (с дублями — их схлопывает апсерт вызывающего);
+    None — фильтр бренда применить не удалось, проход пропущен."""
+    with _pl_quiet(page) as wait_pl_quiet:
+        page.goto(entry_url, wait_until="domcontentloaded")
+        _dismiss(page)
+        wait_pl_quiet()
+    prev = _collect_visible_ids(page)
+    _wait_items_changed(page, prev, timeout_ms=12000)
+    prev = _collect_visible_ids(page)
+    with _pl_quiet(page) as wait_pl_quiet:
+        if not _apply_brand_filter_ui(page, brand, delay):
+            return None
+        wait_pl_quiet()
+    _wait_items_changed(page, prev, timeout_ms=12000)
+    found = _extract_products_on_page(page)
+    before = _collect_visible_ids(page)
+    if page.locator(_LOAD_MORE_COMBINED).first.count():
+        after = _click_load_more_until_stop(page, max_clicks=60, delay=delay, ids=before)
+    else:
+        after = _scroll_until_stable(page, delay, ids=before)
+    if after - before:
+        found.extend(_extract_products_on_page(page, only_ids=after - before))
+    base_for_pages = page.url
+    if c_param:
+        base_for_pages = _add_query_param(base_for_pages, 'c', c_param)
+    if sort:
+        base_for_pages = _add_query_param(base_for_pages, 'sort', sort)
+    known = {it.product_id for it in found if it.product_id}
+    found.extend(_paginate_all_strategies(page, base_for_pages, pages, delay, tab_hook=tab_hook, known_ids=known))
+    return found
+
+def _xhr_array_sink(sink: List[List[Any]]) -> Callable[[Any], None]:
+    """requestfinished-обработчик для рабочего потока: только складывает массивы карточек из JSON-ответов.
+    Разбор/кэш рейтингов/апсерт — в основном потоке, где живёт состояние прогона."""
+    def _on_finished(req) -> None:
+        try:
+            if not any(part in req.url for part in XHR_CAPTURE_URL_PARTS):
+                return
+            resp = req.response()
+            if not resp or not _is_json_like(resp.headers):
+                return
+            if int(resp.headers.get("content-length") or 0) > XHR_MAX_BYTES:
+                return
+            arr, _ = _infer_array_and_next(_json_loads(resp.body()))
+            if arr:
+                sink.append(arr)
+        except Exception:
+            pass
+    return _on_finished
+
+def _brand_pass_isolated(entry_url: str, brand: str, c_param: Optional[str], sort: str, pages: int, delay: float,
+                         headful: bool, proxy: Optional[str], profile_idx: int
+                         ) -> Tuple[Optional[List[Product]], List[List[Any]]]:
+    """_brand_pass в собственном playwright/браузере/контексте — для запуска в рабочем потоке
+    (sync-объекты Playwright нельзя передавать между потоками). Вторым элементом — сырые
+    XHR-массивы карточек, пойманные в этом контексте (вместо tab_hook основного прогона)."""
+    xhr_arrays: List[List[Any]] = []
+    with browser_session(headful, proxy) as browser, _context_scope(browser, proxy, profile_idx) as ctx:
+        ctx.on("requestfinished", _xhr_array_sink(xhr_arrays))
+        found = _brand_pass(ctx.new_page(), entry_url, brand, c_param, sort, pages, delay)
+    return found, xhr_arrays
+
 # ---------------------- Core: one-run collection ----------------------
 def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mode:str,
                        max_items:int, detail_limit:int, no_zone:bool, category:str="smartphones", proxy: Optional[str] = "",
-                       sort: str = "", human_simulation: bool = False, human_brand: Optional[str] = None) -> List[Product]:
+                       sort: str = "", human_simulation: bool = False, human_brand: Optional[str] = None,
+                       browser=None) -> List[Product]:
     items: List[Product] = []
-    # Индекс для апсерта: ключ -> индекс в items
-    index_by_key: Dict[str, int] = {}
+    # Индекс для апсерта: ключ -> сам объект из items (мержим на месте, без items[i] = ...)
+    index_by_key: Dict[str, Product] = {}
     human_brand = (human_brand or "").strip() or None
 
     rating_cache: Dict[str, Tuple[Optional[float], Optional[int]]] = {}
+    # True, если в rating_cache появились новые значения с последнего _apply_rating_cache
+    rating_cache_dirty = False
+
+    # id(obj) -> ключ, только для объектов, лежащих в items: они живы до конца прогона,
+    # поэтому id не переиспользуется. Временные Product'ы из батчей сюда не попадают.
+    key_cache: Dict[int, str] = {}
 
     def _key_for(it: Product) -> str:
-        return it.product_id or f"{it.title}|{it.list_price or ''}"
-
-    def _upsert(new_it: Product):
-        key = _key_for(new_it)
-        if key in index_by_key:
-            i = index_by_key[key]
-            cur = items[i]
-            # Апгрейдим отсутствующие поля
-            if not cur.url and new_it.url:
-                cur.url = new_it.url
-            if cur.list_price is None and new_it.list_price is not None:
-                cur.list_price = new_it.list_price
-            if cur.price_min is None and new_it.price_min is not None:
-                cur.price_min = new_it.price_min
-            if cur.price_default is None and new_it.price_default is not None:
-                cur.price_default = new_it.price_default
-            # Рейтинг/отзывы: если в текущем пусто — берём новое
-            if (cur.rating is None or cur.rating == 0) and (new_it.rating is not None and new_it.rating != 0):
-                cur.rating = new_it.rating
-            if (cur.reviews is None or cur.reviews == 0) and (new_it.reviews is not None and new_it.reviews != 0):
-                cur.reviews = new_it.reviews
-            if not cur.best_merchant and new_it.best_merchant:
-                cur.best_merchant = new_it.best_merchant
-            if not cur.offers_count and new_it.offers_count:
-                cur.offers_count = new_it.offers_count
-            if new_it.errors:
-                cur.errors = (cur.errors + "; " if cur.errors else "") + new_it.errors
-            items[i] = cur
+        key = key_cache.get(id(it))
+        if key is None:
+            key = it.product_id or f"{it.title}|{it.list_price or ''}"
+        return key
+
+    def _key_of_fields(d: Dict[str, Any]) -> str:
+        return d["product_id"] or f"{d['title']}|{d['list_price'] or ''}"
+
+    def _upsert(new_it: Union[Product, Dict[str, Any]]) -> bool:
+        # XHR-путь отдаёт dict с полями Product: дубль мержим прямо из него,
+        # а dataclass создаём только для новой карточки
+        d = new_it if type(new_it) is dict else vars(new_it)
+        key = _key_of_fields(d)
+        cur = index_by_key.get(key)
+        if cur is not None:
+            # Апгрейдим отсутствующие поля; новое значение проверяем первым — у дублей оно чаще пустое
+            for attr in _MERGE_IF_NONE:
+                nv = d[attr]
+                if nv is not None and getattr(cur, attr) is None:
+                    setattr(cur, attr, nv)
+            for attr in _MERGE_IF_EMPTY:
+                nv = d[attr]
+                if nv and not getattr(cur, attr):
+                    setattr(cur, attr, nv)
+            if d["errors"]:
+                cur.errors = (cur.errors + "; " if cur.errors else "") + d["errors"]
             return False  # не новый
-        else:
-            index_by_key[key] = len(items)
-            items.append(new_it)
-            return True  # новый
+        if type(new_it) is dict:
+            new_it = Product(**new_it)
+        index_by_key[key] = new_it
+        key_cache[id(new_it)] = key
+        items.append(new_it)
+        # рейтинг мог прийти из XHR раньше самой карточки
+        cached = rating_cache.get(key)
+        if cached:
+            _fill_rating(new_it, cached)
+        return True  # новый
+
+    def _upsert_many(batch: Iterable[Union[Product, Dict[str, Any], None]], cap: Optional[int] = None) -> int:
+        """Апсерт пачки (пустые элементы пропускаются); возвращает число новых карточек.
+        cap — остановиться, как только в items набралось cap карточек (остаток пачки не разбираем)."""
+        upsert = _upsert
+        added = 0
+        for it in batch:
+            if cap is not None and len(items) >= cap:
+                break
+            if it and upsert(it):
+                added += 1
+        return added
+
+    def _fill_rating(it: Product, cached: Tuple[Optional[float], Optional[int]]) -> bool:
+        cr, cv = cached
+        applied = False
+        if cr not in (None, 0) and (it.rating is None or it.rating == 0):
+            it.rating = cr
+            applied = True
+        if cv not in (None, 0) and (it.reviews is None or it.reviews == 0):
+            try:
+                it.reviews = int(cv)
+            except Exception:
+                pass
+            applied = True
+        return applied
 
-    def _cache_rating(prod: Product):
+    def _cache_rating(prod: Union[Product, Dict[str, Any]]):
+        nonlocal rating_cache_dirty
         if not prod:
             return
-        keys: List[str] = []
-        if prod.product_id:
-            keys.append(prod.product_id)
-        fallback = _key_for(prod)
-        if fallback and fallback not in keys:
-            keys.append(fallback)
-        for key in keys:
-            prev = rating_cache.get(key, (None, None))
-            cached_rating = prev[0]
-            cached_reviews = prev[1]
-            new_rating = prod.rating if prod and prod.rating not in (None, 0) else cached_rating
-            new_reviews = prod.reviews if prod and prod.reviews not in (None, 0) else cached_reviews
-            rating_cache[key] = (new_rating, new_reviews)
-        if items:
-            _apply_rating_cache()
+        d = prod if type(prod) is dict else vars(prod)
+        # ключ — product_id, а без него title|list_price (как в _upsert)
+        key = _key_of_fields(d)
+        prev = rating_cache.get(key, (None, None))
+        new_rating = d["rating"] if d["rating"] not in (None, 0) else prev[0]
+        new_reviews = d["reviews"] if d["reviews"] not in (None, 0) else prev[1]
+        if (new_rating, new_reviews) == prev:
+            return
+        rating_cache[key] = (new_rating, new_reviews)
+        rating_cache_dirty = True
+        # точечно обновляем уже собранную карточку вместо полного прохода по items
+        cur = index_by_key.get(key)
+        if cur is not None and cur is not prod:
+            _fill_rating(cur, rating_cache[key])
 
     def _apply_rating_cache() -> int:
+        nonlocal rating_cache_dirty
+        # полный проход нужен только если кэш пополнился с прошлого раза
+        if not rating_cache_dirty:
+            return 0
+        rating_cache_dirty = False
         updated = 0
         for it in items:
             keys: List[str] = []
@@ -1252,22 +2658,9 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
             fallback = _key_for(it)
             if fallback and fallback not in keys:
                 keys.append(fallback)
-            applied = False
             for key in keys:
                 cached = rating_cache.get(key)
-                if not cached:
-                    continue
-                cr, cv = cached
-                if cr not in (None, 0) and (it.rating is None or it.rating == 0):
-                    it.rating = cr
-                    applied = True
-                if cv not in (None, 0) and (it.reviews is None or it.reviews == 0):
-                    try:
-                        it.reviews = int(cv)
-                    except Exception:
-                        pass
-                    applied = True
-                if applied:
+                if cached and _fill_rating(it, cached):
                     updated += 1
                     break
         if updated:
@@ -1285,7 +2678,9 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
     results_pages_seen: Set[int] = set()
     results_base_url: Optional[str] = None
 
-    # Буфер XHR-выдач, которые ещё не интегрированы в итоговый список
+    # Буфер XHR-выдач, которые ещё не интегрированы в итоговый список.
+    # Храним уже разобранные поля карточек (dict под Product), а не сырые JSON-массивы —
+    # так буфер не раздувается на глубоких категориях.
     pending_xhr_payloads: List[Tuple[List[Dict[str, Any]], Dict[str, Any]]] = []
 
     # Накопим, сколько карточек реально загрузил UI через этот же endpoint — стартовый offset для XHR
@@ -1294,33 +2689,34 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
     captured_total: Optional[int] = None
 
     def _id_from_obj(obj: dict) -> Optional[str]:
-        try:
-            pid = (
-                obj.get("productId")
-                or obj.get("id")
-                or obj.get("configSku")
-                or obj.get("product_id")
-                or ""
-            )
-            pid = str(pid) if pid is not None else ""
-            pid = pid.strip()
-            return pid or None
-        except Exception:
+        if type(obj) is not dict:
             return None
-
-    def _price_from_obj(val: Any) -> Optional[float]:
-        if val is None:
+        get = obj.get
+        pid = get("productId") or get("id") or get("configSku") or get("product_id")
+        if not pid:
             return None
-        if isinstance(val, (int, float)):
+        # productId в XHR — int или строка: точный тип без try/except и лишних str()/strip()
+        t = type(pid)
+        if t is int:
+            return str(pid)
+        if t is not str:
             try:
-                return float(val)
+                pid = str(pid)
             except Exception:
                 return None
-        if isinstance(val, str):
+        return pid.strip() or None
+
+    def _price_from_obj(val: Any) -> Optional[float]:
+        # в XHR цены почти всегда числа — проверяем точный тип до регэкспа
+        t = type(val)
+        if t is int or t is float:
+            return float(val)
+        if t is str:
             return _regex_price_to_float(val)
         return None
 
-    def _product_from_xhr_obj(obj: dict) -> Optional[Product]:
+    def _xhr_obj_to_dict(obj: dict) -> Optional[Dict[str, Any]]:
+        """Поля Product из XHR-объекта в виде dict; Product создаст _upsert, если карточка новая."""
         if not isinstance(obj, dict):
             return None
         pid = _id_from_obj(obj)
@@ -1329,7 +2725,7 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
             return None
         raw_url = obj.get("shopLink") or obj.get("link") or obj.get("url")
         if isinstance(raw_url, str) and raw_url.startswith("/"):
-            url = "https://kaspi.kz" + raw_url
+            url = KASPI_ORIGIN + raw_url
         else:
             url = raw_url
         list_price = _price_from_obj(obj.get("unitPrice") or obj.get("price") or obj.get("basePrice"))
@@ -1339,28 +2735,11 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
             or obj.get("minPrice")
             or obj.get("priceMin")
         )
-        rating = None
-        try:
-            if obj.get("rating") is not None:
-                rating = float(obj.get("rating"))
-        except Exception:
-            rating = None
-        reviews = None
-        try:
-            if obj.get("reviewsQuantity") is not None:
-                reviews = int(obj.get("reviewsQuantity"))
-            elif obj.get("reviewsCount") is not None:
-                reviews = int(obj.get("reviewsCount"))
-        except Exception:
-            reviews = None
-        offers_count = None
-        try:
-            if obj.get("merchantCount") is not None:
-                offers_count = int(obj.get("merchantCount"))
-            elif obj.get("offersCount") is not None:
-                offers_count = int(obj.get("offersCount"))
-        except Exception:
-            offers_count = None
+        rating = _num_or_none(obj.get("rating"), float)
+        v = obj.get("reviewsQuantity")
+        reviews = _num_or_none(v if v is not None else obj.get("reviewsCount"), int)
+        v = obj.get("merchantCount")
+        offers_count = _num_or_none(v if v is not None else obj.get("offersCount"), int)
         best_merchant = None
         major_merchants = obj.get("majorMerchants")
         if isinstance(major_merchants, list) and major_merchants:
@@ -1369,26 +2748,80 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                 best_merchant = str(first.get("title") or first.get("name") or first.get("merchantName") or "").strip() or None
             elif isinstance(first, str):
                 best_merchant = first.strip() or None
-        prod = Product(
-            product_id=pid,
-            title=title,
-            url=url,
-            list_price=list_price,
-            price_min=sale_price,
-            price_default=sale_price or list_price,
-            rating=rating,
-            reviews=reviews,
-            offers_count=offers_count,
-            best_merchant=best_merchant,
-        )
-        return prod
+        return {
+            "product_id": pid,
+            "title": title,
+            "url": url,
+            "list_price": list_price,
+            "price_min": sale_price,
+            "price_default": sale_price or list_price,
+            "rating": rating,
+            "reviews": reviews,
+            "offers_count": offers_count,
+            "best_merchant": best_merchant,
+            "errors": None,
+        }
 
-    with sync_playwright() as p:
-        if proxy:
-            browser = p.chromium.launch(headless=not headful, proxy={"server": proxy})
-        else:
-            browser = p.chromium.launch(headless=not headful)
-        ctx = browser.new_context(**_ctx_opts())
+    def _xhr_page_card(obj: Any) -> Optional[Dict[str, Any]]:
+        """Поля карточки для offset/page-пагинации: читаем только нужные ключи объекта
+        и отдаём dict для _upsert (Product создаётся только для новой карточки)."""
+        if not isinstance(obj, dict):
+            return None
+        get = obj.get  # десяток обращений на карточку — без повторного поиска метода
+        title = get("title") or get("name") or ""
+        if not title:
+            return None
+        urlp = get("shopLink") or get("url") or get("href") or None
+        if urlp and urlp[0] == "/":
+            urlp = KASPI_ORIGIN + urlp
+        lp = None
+        # ключи по приоритету; обычно срабатывает первый, остальные не читаем
+        for key in _XHR_PRICE_KEYS:
+            pf = get(key)
+            if pf is None:
+                continue
+            lp = _regex_price_to_float(pf)
+            if lp is not None:
+                break
+        rating_val = _num_or_none(get("rating"), float)
+        reviews_val = _num_or_none(get("reviewsQuantity"), int)
+        return {
+            "product_id": _id_from_obj(obj),
+            "title": title,
+            "url": urlp,
+            "list_price": lp,
+            "price_min": None,
+            "price_default": None,
+            "rating": rating_val,
+            "reviews": reviews_val,
+            "offers_count": None,
+            "best_merchant": None,
+            "errors": None,
+        }
+
+    def _parse_xhr_arr(arr: List[Any]) -> Tuple[Set[str], List[Dict[str, Any]]]:
+        """Один проход по массиву XHR: (все ID ответа, поля карточек для _upsert).
+        ID берём и у объектов без названия — они нужны для шага offset."""
+        ids: Set[str] = set()
+        prods: List[Dict[str, Any]] = []
+        for obj in arr:
+            try:
+                d = _xhr_obj_to_dict(obj)
+            except Exception:
+                d = None
+            pid = d["product_id"] if d else _id_from_obj(obj)
+            if pid:
+                ids.add(pid)
+            if d:
+                prods.append(d)
+        return ids, prods
+
+    # у каждого контекста свой UA/viewport-профиль; те же заголовки — и для XHR-пагинации
+    profile_idx = _next_profile_idx()
+    shared_browser = browser is not None
+    with _browser_scope(browser, headful, proxy) as browser, \
+            _context_scope(browser, proxy, profile_idx, shared=shared_browser) as ctx, \
+            _api_scope(ctx, proxy, shared_key=id(browser) if shared_browser else None) as api:
         page = ctx.new_page()
         _ensure_dir("logs")
         def _integrate_pending_xhr(reason: str = "") -> int:
@@ -1398,15 +2831,9 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
             added_total = 0
             batches = len(pending_xhr_payloads)
             for payload, meta in pending_xhr_payloads:
-                for obj in payload:
-                    prod = _product_from_xhr_obj(obj)
-                    if not prod:
-                        continue
-                    _cache_rating(prod)
-                    if prod.product_id:
-                        captured_ids.add(prod.product_id)
-                    if _upsert(prod):
-                        added_total += 1
+                # рейтинг уже закэширован при получении (on_request_finished)
+                captured_ids.update({prod["product_id"] for prod in payload if prod["product_id"]})
+                added_total += _upsert_many(payload, cap=max_items)
             _apply_rating_cache()
             if added_total:
                 logger.info(
@@ -1427,16 +2854,25 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
             return added_total
 
         def on_request_finished(req):
-            nonlocal last_ep, next_hints, page_size_guess, captured_limit, captured_total
-            nonlocal results_ep, results_params_template, results_pages_seen
+            nonlocal last_ep, first_ep, next_hints, page_size_guess, captured_limit, captured_total
+            nonlocal results_ep, results_params_template, results_pages_seen, results_base_url
             try:
+                url = req.url
+                if not any(part in url for part in XHR_CAPTURE_URL_PARTS):
+                    return
                 resp = req.response()
                 if not resp:
                     return
-                if not _is_json_like(dict(resp.headers)):
+                headers = resp.headers
+                if not _is_json_like(headers):
                     return
+                try:
+                    if int(headers.get("content-length") or 0) > XHR_MAX_BYTES:
+                        logger.debug("XHR %s больше лимита (%s) — пропуск", url, headers.get("content-length"))
+                        return
+                except ValueError:
+                    pass
                 method = req.method
-                url = req.url
                 body = None
                 try:
                     body = req.post_data or None
@@ -1444,13 +2880,15 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                     body = None
                 data = None
                 try:
-                    data = resp.json()
+                    # resp.json() парсит stdlib json; orjson на байтах заметно быстрее на больших выдачах
+                    data = _json_loads(resp.body())
                 except Exception:
                     data = None
                 if data is None:
                     return
-                _save_dump("xhr_req", {"method": method, "url": url, "req_headers": dict(req.headers), "body": body or ""})
-                _save_dump("xhr_resp", {"url": url, "data": data})
+                if SAVE_DUMPS:
+                    _save_dump("xhr_req", {"method": method, "url": url, "req_headers": dict(req.headers), "body": body or ""})
+                    _save_dump("xhr_resp", {"url": url, "data": data})
                 arr, hints = _infer_array_and_next(data)
                 ep = CapturedEndpoint(
                     method=method,
@@ -1465,40 +2903,17 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                     if first_ep is None:
                         first_ep = ep
                     try:
-                        parsed = urlparse(url)
-                        if parsed.path.endswith("/pl/results"):
-                            qs = parse_qs(parsed.query)
+                        path, page_no, params = _split_xhr_url(url)
+                        if page_no is not None and path.endswith(("/pl/results", "/pl/filters")):
+                            results_pages_seen.add(page_no)
+                        if path.endswith("/pl/results"):
                             results_ep = ep
-                            tmp: Dict[str, str] = {}
-                            for k, v in qs.items():
-                                if not v:
-                                    tmp[k] = ""
-                                    continue
-                                if k == "page":
-                                    try:
-                                        results_pages_seen.add(int(v[0]))
-                                    except Exception:
-                                        pass
-                                    continue
-                                tmp[k] = v[0]
-                            if tmp:
-                                results_params_template.update(tmp)
+                            if params:
+                                results_params_template.update(params)
                             results_base_url = url
-                        elif parsed.path.endswith("/pl/filters"):
-                            qs = parse_qs(parsed.query)
+                        elif path.endswith("/pl/filters"):
                             base_url = url.replace("/pl/filters", "/pl/results")
-                            template: Dict[str, str] = {}
-                            for k, v in qs.items():
-                                if not v:
-                                    template[k] = ""
-                                    continue
-                                if k == "page":
-                                    try:
-                                        results_pages_seen.add(int(v[0]))
-                                    except Exception:
-                                        pass
-                                    continue
-                                template[k] = v[0]
+                            template: Dict[str, str] = dict(params)
                             meta_info = data.get("data") if isinstance(data, dict) else {}
                             if isinstance(meta_info, dict):
                                 ext = meta_info.get("externalSearchQueryInfo")
@@ -1513,9 +2928,15 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                         pass
                     next_hints = hints or next_hints
                     page_size_guess = max(page_size_guess, len(arr))
+                    # Разбираем массив один раз: поля карточек идут и в кэш рейтингов, и в буфер.
+                    # ID копим, чтобы стартовать offset с того места, докуда уже дошёл UI
+                    resp_ids, prods = _parse_xhr_arr(arr)
+                    captured_ids.update(resp_ids)
+                    for prod in prods:
+                        _cache_rating(prod)
                     pending_xhr_payloads.append(
                         (
-                            list(arr),
+                            prods,
                             {
                                 "url": url,
                                 "captured_at": time.time(),
@@ -1524,18 +2945,6 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                             },
                         )
                     )
-                    try:
-                        for obj in arr:
-                            prod = _product_from_xhr_obj(obj)
-                            if prod:
-                                _cache_rating(prod)
-                    except Exception:
-                        pass
-                    # Накопим ID карточек, которые уже пришли через UI XHR — чтобы стартовать offset с этого места
-                    for obj in arr:
-                        pid = _id_from_obj(obj) or ""
-                        if pid:
-                            captured_ids.add(pid)
                     try:
                         meta = data.get("data") if isinstance(data, dict) else {}
                         if isinstance(meta, dict):
@@ -1574,7 +2983,6 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
             entry_used = search_url
         if not entry_used:
             logger.info("Не удалось отрисовать карточки на входе — завершаем.")
-            browser.close()
             return items
 
         # UI стр.1
@@ -1588,47 +2996,116 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
         )
         # Зафиксируем c-параметр зоны/города при наличии и будем добавлять его в пагинацию
         c_param = _detect_c_param(page)
-        for it in batch:
-            _upsert(it)
-        _apply_rating_cache()
+        _upsert_many(batch, cap=max_items)
 
         if items and len(items) < max_items:
             if not pending_xhr_payloads:
-                wait_until = time.time() + max(1.2, delay)
-                while not pending_xhr_payloads and time.time() < wait_until:
-                    time.sleep(0.15)
+                _poll_until(lambda: bool(pending_xhr_payloads), max(1.2, delay), initial=0.4,
+                            sleep=_listing_xhr_sleep(page))
             if pending_xhr_payloads:
                 _integrate_pending_xhr("после стартовой HTML страницы")
-            else:
-                _apply_rating_cache()
+        _apply_rating_cache()
 
         # Сначала пробуем load-more/скролл в любом случае
         grown = False
-        if any(page.locator(s).first.count() for s in ALL_LOAD_MORE_SELECTORS):
+        if page.locator(_LOAD_MORE_COMBINED).first.count():
             logger.info("Пробуем «Показать ещё».")
-            before = len(_collect_visible_ids(page))
-            _click_load_more_until_stop(page, max_clicks=60, delay=delay)
-            after = len(_collect_visible_ids(page))
-            grown = after > before
+            before = _collect_visible_ids(page)
+            after = _click_load_more_until_stop(page, max_clicks=60, delay=delay, ids=before)
+            grown = bool(after - before)
         else:
-            before = len(_collect_visible_ids(page))
-            for _ in range(12):
+            before = _collect_visible_ids(page)
+            after = _scroll_until_stable(page, delay, ids=before)
+            grown = bool(after - before)
+        if grown:
+            # стартовые карточки уже в items — разбираем только дозагруженные
+            b = _extract_products_on_page(page, only_ids=after - before)
+            added = _upsert_many(b, cap=max_items)
+            logger.info("Дозагрузили карточек: +%s (итого: %s)", added, len(items))
+
+        def _direct_results_pages() -> bool:
+            """Если /pl/results уже пойман (есть requestId) — тянем оставшиеся страницы JSON'ом
+            параллельно, без рендера в Chromium. False — endpoint не пойман, 403 или пусто: идём в UI."""
+            nonlocal results_ep, last_ep, captured_limit, captured_total
+            base_candidate = results_ep.url if results_ep else results_base_url
+            if not base_candidate or not results_params_template.get("requestId") or len(items) >= max_items:
+                return False
+            start = (max(results_pages_seen) if results_pages_seen else 1) + 1
+            if start > pages:
+                return False
+            params = dict(results_params_template)
+            for key in ("all", "offset", "i"):
+                params.pop(key, None)
+            if c_param:
+                params.setdefault("c", str(c_param))
+            if sort:
+                params.setdefault("sort", str(sort))
+            params.setdefault("ui", "d")
+            params.setdefault("fl", "true")
+            base_results_url = _strip_zone_in_q(base_candidate) if no_zone else base_candidate
+            urls = [_set_query_params(base_results_url, {**params, "page": str(n)}) for n in range(start, pages + 1)]
+            headers = {
+                k: v for k, v in ((results_ep.req_headers if results_ep else None) or {}).items()
+                if not k.startswith(":") and k.lower() not in ("host", "cookie", "content-length", "accept-encoding")
+            }
+            headers.setdefault("accept", "application/json, text/plain, */*")
+            headers.setdefault("user-agent", _ctx_opts(profile_idx)["user_agent"])
+            headers.setdefault("referer", entry_used or cat_url)
+            if c_param:
+                headers.setdefault("x-ks-city", str(c_param))
+            logger.info("Прямой XHR /pl/results: страницы %s..%s параллельно (x%s).", start, pages, RESULTS_CONCURRENCY)
+            responses = api.get_many(urls, timeout=25000, headers=headers, workers=RESULTS_CONCURRENCY)
+            if any(r is not None and r.status == 403 for r in responses):
+                logger.info("Прямой XHR /pl/results: HTTP 403 — уходим в UI-пагинацию.")
+                return False
+            added_total = 0
+            for page_no, url, r in zip(range(start, pages + 1), urls, responses):
+                if len(items) >= max_items:
+                    break
+                if r is None or not r.ok:
+                    logger.info("Прямой XHR page=%s -> HTTP %s — стоп.", page_no, getattr(r, "status", "-"))
+                    break
+                try:
+                    data = _json_loads(r.body())
+                except Exception:
+                    logger.info("Прямой XHR page=%s: ответ не JSON — стоп.", page_no)
+                    break
+                _dump_follow(url, data)
+                arr, _ = _infer_array_and_next(data)
+                if not arr and isinstance(data, dict):
+                    payload = data.get("data")
+                    if isinstance(payload, list) and payload and isinstance(payload[0], dict):
+                        arr = payload
+                if not arr:
+                    logger.info("Прямой XHR page=%s: без карточек — стоп.", page_no)
+                    break
+                resp_ids, prods = _parse_xhr_arr(arr)
+                captured_ids.update(resp_ids)
+                added = _upsert_many(prods, cap=max_items)
+                results_pages_seen.add(page_no)
+                added_total += added
                 try:
-                    page.evaluate("window.scrollBy(0, Math.max(400, document.body.scrollHeight * 0.85))")
+                    meta = data.get("data") if isinstance(data, dict) else {}
+                    if isinstance(meta, dict):
+                        if meta.get("limit") is not None:
+                            captured_limit = max(int(meta.get("limit") or 0), captured_limit or 0)
+                        if meta.get("total") is not None:
+                            captured_total = int(meta.get("total"))
                 except Exception:
                     pass
-                time.sleep(delay)
-            after = len(_collect_visible_ids(page))
-            grown = after > before
-        if grown:
-            b = _extract_products_on_page(page)
-            added = 0
-            for it in b:
-                _upsert(it)
-                added += 1
-            logger.info("Дозагрузили карточек: +%s (итого: %s)", added, len(items))
+                results_ep = CapturedEndpoint(method="GET", url=url, req_headers=headers, req_body=None, resp_json=data)
+                last_ep = results_ep
+            logger.info("Прямой XHR /pl/results: +%s карточек (итого %s)", added_total, len(items))
+            return added_total > 0
 
-        if human_simulation:
+        direct_done = False
+        try:
+            direct_done = _direct_results_pages()
+        except Exception as e:
+            logger.info("Прямой XHR /pl/results упал: %s — UI-пагинация.", e)
+        if direct_done:
+            _apply_rating_cache()
+        elif human_simulation:
             logger.info("Включен режим имитации человека: пробуем листать пагинацию через UI.")
             if human_brand:
                 prev_ids = _collect_visible_ids(page)
@@ -1636,12 +3113,8 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                 if applied:
                     _wait_items_changed(page, prev_ids, timeout_ms=15000)
                     filtered_batch = _extract_products_on_page(page)
-                    new_added = 0
-                    for it in filtered_batch:
-                        if _upsert(it):
-                            new_added += 1
-                        if it.product_id:
-                            captured_ids.add(it.product_id)
+                    new_added = _upsert_many(filtered_batch, cap=max_items)
+                    captured_ids.update({it.product_id for it in filtered_batch if it.product_id})
                     logger.info("Human режим: фильтр '%s' применён, +%s карточек (итого %s)", human_brand, new_added, len(items))
                 else:
                     logger.info("Human режим: не удалось применить фильтр '%s'", human_brand)
@@ -1649,7 +3122,7 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                 page,
                 pages=pages,
                 delay=delay,
-                upsert_cb=_upsert,
+                upsert_many_cb=lambda batch: _upsert_many(batch, cap=max_items),
                 captured_ids=captured_ids,
                 get_items_len=lambda: len(items),
                 max_items=max_items,
@@ -1661,107 +3134,95 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                 _integrate_pending_xhr("после human UI")
         else:
             # Далее HTML-пагинация (?page=, Следующая, номера)
-            try:
-                base_for_pages = entry_used or cat_url
-                if c_param:
-                    base_for_pages = _add_query_param(base_for_pages, 'c', c_param)
-                more = _paginate_by_page_param(page, base_for_pages, start_page=2, pages=pages, delay=delay)
-            except Exception:
-                more = []
-            try:
-                extra = _paginate_by_nav_next(page, pages=pages, delay=delay)
-            except Exception:
-                extra = []
-            if extra:
-                more.extend(extra)
-            try:
-                extra2 = _paginate_by_nav_numbers(page, pages=pages, delay=delay)
-            except Exception:
-                extra2 = []
-            if extra2:
-                more.extend(extra2)
+            base_for_pages = entry_used or cat_url
+            if c_param:
+                base_for_pages = _add_query_param(base_for_pages, 'c', c_param)
+            more = _paginate_all_strategies(page, base_for_pages, pages, delay,
+                                            tab_hook=lambda t: t.on("requestfinished", on_request_finished),
+                                            known_ids={it.product_id for it in items if it.product_id})
             if more:
-                added = 0
-                for it in more:
-                    _upsert(it)
-                    added += 1
+                added = _upsert_many(more, cap=max_items)
                 logger.info("HTML-пагинация ?page=/Следующая/цифры: +%s карточек (итого: %s)", added, len(items))
 
             brand_filters = DEFAULT_BRANDS if (category == "smartphones") else []
-            for bname in brand_filters:
-                if len(items) >= max_items:
-                    break
+            brand_entry = entry_used or cat_url
+            # доп. браузеры — из общих слотов процесса; меньше двух не имеет смысла, тогда по очереди на основной вкладке
+            brand_slots = 0
+            if BRAND_CONCURRENCY > 1 and len(brand_filters) > 1:
+                brand_slots = _take_brand_slots(min(BRAND_CONCURRENCY, len(brand_filters)))
+                if brand_slots < 2:
+                    _give_brand_slots(brand_slots)
+                    brand_slots = 0
+            if brand_slots:
+                workers = brand_slots
                 try:
-                    logger.info("Фильтр производитель: %s", bname)
-                    page.goto(entry_used or cat_url, wait_until="domcontentloaded")
-                    _dismiss(page)
-                    try:
-                        page.wait_for_load_state("networkidle", timeout=8000)
-                    except Exception:
-                        pass
-                    prev = _collect_visible_ids(page)
-                    _wait_items_changed(page, prev, timeout_ms=12000)
-                    b0 = _extract_products_on_page(page)
-                    added0 = 0
-                    for it in b0:
-                        if _upsert(it):
-                            added0 += 1
-                    if added0:
-                        logger.info("Стр. бренда '%s': +%s", bname, added0)
-                    before = len(_collect_visible_ids(page))
-                    if any(page.locator(s).first.count() for s in ALL_LOAD_MORE_SELECTORS):
-                        _click_load_more_until_stop(page, max_clicks=60, delay=delay)
-                    else:
-                        for _ in range(12):
+                    # Бренды независимы: гоняем их параллельно, каждый в своём браузере и контексте,
+                    # а результаты апсертим здесь, в основном потоке — в порядке brand_filters,
+                    # чтобы при упоре в max_items состав выдачи не зависел от того, какой поток успел раньше
+                    logger.info("Фильтры производителей: %s брендов, %s параллельно", len(brand_filters), workers)
+                    with ThreadPoolExecutor(max_workers=workers) as pool:
+                        futures = [
+                            (bname, pool.submit(_brand_pass_isolated, brand_entry, bname, c_param, sort, pages, delay,
+                                                headful, proxy, _next_profile_idx()))
+                            for bname in brand_filters
+                        ]
+                        for bname, fut in futures:
+                            if fut.cancelled():
+                                continue
                             try:
-                                page.evaluate("window.scrollBy(0, Math.max(400, document.body.scrollHeight * 0.85))")
-                            except Exception:
-                                pass
-                            time.sleep(delay)
-                    after = len(_collect_visible_ids(page))
-                    if after > before:
-                        b1 = _extract_products_on_page(page)
-                        for it in b1:
-                            _upsert(it)
-                    base_for_pages = page.url
-                    if c_param:
-                        base_for_pages = _add_query_param(base_for_pages, 'c', c_param)
-                    if sort:
-                        base_for_pages = _add_query_param(base_for_pages, 'sort', sort)
-                    try:
-                        more_b = _paginate_by_page_param(page, base_for_pages, start_page=2, pages=pages, delay=delay)
-                    except Exception:
-                        more_b = []
-                    try:
-                        extra_b = _paginate_by_nav_next(page, pages=pages, delay=delay)
-                    except Exception:
-                        extra_b = []
+                                found, xhr_arrays = fut.result()
+                                # XHR брендового контекста — в общий буфер, как это делает tab_hook на основной вкладке
+                                for arr in xhr_arrays:
+                                    resp_ids, prods = _parse_xhr_arr(arr)
+                                    captured_ids.update(resp_ids)
+                                    for prod in prods:
+                                        _cache_rating(prod)
+                                    pending_xhr_payloads.append(
+                                        (prods, {"url": brand_entry, "captured_at": time.time(), "size": len(arr), "hints": {}})
+                                    )
+                                if found is None:
+                                    logger.info("Фильтр по бренду '%s' не применился — пропуск", bname)
+                                    continue
+                                brand_added = _upsert_many(found, cap=max_items)
+                                if brand_added:
+                                    logger.info("Бренд '%s': +%s (итого %s)", bname, brand_added, len(items))
+                            except Exception as e:
+                                logger.info("Фильтр по бренду '%s' не сработал: %s", bname, e)
+                            if len(items) >= max_items:
+                                # ещё не начатые бренды не запускаем
+                                for _, f in futures:
+                                    f.cancel()
+                finally:
+                    _give_brand_slots(brand_slots)
+            else:
+                for bname in brand_filters:
+                    if len(items) >= max_items:
+                        break
                     try:
-                        extra2_b = _paginate_by_nav_numbers(page, pages=pages, delay=delay)
-                    except Exception:
-                        extra2_b = []
-                    brand_added = 0
-                    for seq in (more_b, extra_b, extra2_b):
-                        for it in seq:
-                            if _upsert(it):
-                                brand_added += 1
-                    if brand_added:
-                        logger.info("HTML пагинации по бренду '%s': +%s (итого %s)", bname, brand_added, len(items))
-                except Exception as e:
-                    logger.info("Фильтр по бренду '%s' не сработал: %s", bname, e)
+                        logger.info("Фильтр производитель: %s", bname)
+                        found = _brand_pass(page, brand_entry, bname, c_param, sort, pages, delay,
+                                            tab_hook=lambda t: t.on("requestfinished", on_request_finished))
+                        if found is None:
+                            logger.info("Фильтр по бренду '%s' не применился — пропуск", bname)
+                            continue
+                        brand_added = _upsert_many(found, cap=max_items)
+                        if brand_added:
+                            logger.info("Бренд '%s': +%s (итого %s)", bname, brand_added, len(items))
+                    except Exception as e:
+                        logger.info("Фильтр по бренду '%s' не сработал: %s", bname, e)
 
             if len(items) < max_items:
                 _integrate_pending_xhr("после HTML UI")
 
         if last_ep and len(items) < max_items:
             logger.info("Пробуем XHR-пагинацию (без UI).")
-            req = ctx.request
+            req = api
             ep = last_ep
             rounds_left = max(0, pages - 1)
             base_headers = {
                 "accept": "application/json, text/plain, */*",
                 "accept-language": "ru-RU,ru;q=0.9,en-US;q=0.8",
-                "user-agent": _ctx_opts()["user_agent"],
+                "user-agent": _ctx_opts(profile_idx)["user_agent"],
             }
             # Добавим x-ks-city и referer если можем
             try:
@@ -1772,20 +3233,8 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
             base_referer = entry_used or cat_url
             if base_referer:
                 base_headers["referer"] = base_referer
-            # Построим базовый URL без page, будем ходить по offset, начиная с числа карточек, реально полученных UI
+            # Базовый URL без page строим ниже, будем ходить по offset, начиная с числа карточек, реально полученных UI
             # Если UI ничего не подгружал — captured_ids может быть пустым (offset=0)
-            def _strip_params_page(url: str) -> str:
-                try:
-                    from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
-                    pr = urlparse(url)
-                    qs = parse_qs(pr.query)
-                    if "page" in qs:
-                        qs.pop("page", None)
-                    new_q = urlencode({k: v[0] if isinstance(v, list) and v else v for k, v in qs.items()})
-                    return urlunparse((pr.scheme, pr.netloc, pr.path, pr.params, new_q, pr.fragment))
-                except Exception:
-                    return url
-
             # если limit/total ещё не известны — возьмём из ep.resp_json
             if captured_limit is None or captured_total is None:
                 try:
@@ -1800,19 +3249,6 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
             # В крайнем случае используем page_size_guess
             limit_eff = int(captured_limit or page_size_guess or 12)
 
-            # Хелпер: убрать указанные query-параметры
-            def _strip_params(url: str, keys: List[str]) -> str:
-                try:
-                    from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
-                    pr = urlparse(url)
-                    qs = parse_qs(pr.query)
-                    for k in keys:
-                        qs.pop(k, None)
-                    new_q = urlencode({k: v[0] if isinstance(v, list) and v else v for k, v in qs.items()})
-                    return urlunparse((pr.scheme, pr.netloc, pr.path, pr.params, new_q, pr.fragment))
-                except Exception:
-                    return url
-
             added_any_xhr = False
 
             def _ensure_request_id_via_filters(base_results_url: str) -> bool:
@@ -1841,12 +3277,11 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                     logger.info("XHR GET %s -> HTTP %s при попытке requestId — пропуск.", filters_url, r.status)
                     return False
                 try:
-                    data = r.json()
+                    data = _json_loads(r.body())
                 except Exception:
                     logger.info("XHR /pl/filters для requestId вернул не JSON — пропуск.")
                     return False
-                _save_dump("xhr_follow_req", {"method": "GET", "url": filters_url, "body": ""})
-                _save_dump("xhr_follow_resp", {"url": filters_url, "data": data})
+                _dump_follow(filters_url, data)
                 req_id = _extract_request_id_from_data(data)
                 if req_id:
                     results_params_template["requestId"] = req_id
@@ -1861,7 +3296,7 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                     except Exception:
                         pass
                     try:
-                        results_base_url = _strip_params(filters_url.replace("/pl/filters", "/pl/results"), ["offset", "i"])
+                        results_base_url = _strip_query_params(filters_url.replace("/pl/filters", "/pl/results"), ("offset", "i"))
                     except Exception:
                         results_base_url = filters_url.replace("/pl/filters", "/pl/results")
                     return True
@@ -1879,7 +3314,7 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                         results_base_url = base_candidate
                 if not base_candidate:
                     return False
-                base_results_url = _strip_params(base_candidate, ["page", "offset", "i"])
+                base_results_url = _strip_query_params(base_candidate, ("page", "offset", "i"))
                 if no_zone:
                     base_results_url = _strip_zone_in_q(base_results_url)
                 template_params = dict(results_params_template)
@@ -1909,80 +3344,88 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                 next_page = max_page_seen + 1
                 progress = False
                 logger.info("Пробуем XHR пагинацию по /pl/results.")
-                while rounds_left_results > 0 and len(items) < max_items:
-                    params = dict(template_params)
-                    params["page"] = str(next_page)
-                    new_url = _set_query_params(base_results_url, params)
+                # шаблон разбираем один раз; страницы окна запрашиваем параллельно (HTTP/2-потоки
+                # одного соединения), а разбираем по порядку с прежними условиями остановки
+                results_base = _strip_query_params(base_results_url, tuple(template_params) + ("page",))
+                stop = False
+                while not stop and rounds_left_results > 0 and len(items) < max_items:
+                    window = list(range(next_page, next_page + min(RESULTS_CONCURRENCY, rounds_left_results)))
+                    urls = [_append_query(results_base, {**template_params, "page": str(n)}) for n in window]
                     try:
-                        r = req.get(new_url, timeout=25000, headers=base_headers)
+                        responses = req.get_many(urls, timeout=25000, headers=base_headers,
+                                                 workers=RESULTS_CONCURRENCY)
                     except Exception as e:
                         logger.info("XHR /pl/results fetch упал: %s — стоп.", e)
                         break
-                    if not r.ok:
-                        logger.info("XHR GET %s -> HTTP %s — стоп.", new_url, r.status)
-                        break
-                    try:
-                        data = r.json()
-                    except Exception:
-                        logger.info("XHR /pl/results ответ не JSON — стоп.")
-                        break
-                    _save_dump("xhr_follow_req", {"method": "GET", "url": new_url, "body": ""})
-                    _save_dump("xhr_follow_resp", {"url": new_url, "data": data})
-                    arr, hints = _infer_array_and_next(data)
-                    if not arr and isinstance(data, dict):
-                        payload = data.get("data")
-                        if isinstance(payload, list) and payload and isinstance(payload[0], dict):
-                            arr = payload
-                            hints = {}
-                    if not arr:
-                        logger.info("XHR /pl/results: ответ без карточек — стоп.")
-                        break
-                    added = 0
-                    new_ids: Set[str] = set()
-                    for obj in arr:
-                        pid = _id_from_obj(obj)
-                        if pid:
-                            new_ids.add(pid)
-                        prod = _product_from_xhr_obj(obj)
-                        if prod and _upsert(prod):
-                            added += 1
-                    for pid in new_ids:
-                        captured_ids.add(pid)
-                    results_pages_seen.add(next_page)
-                    req_id_resp = _extract_request_id_from_data(data)
-                    if req_id_resp and results_params_template.get("requestId") != req_id_resp:
-                        results_params_template["requestId"] = req_id_resp
-                    if added:
-                        progress = True
-                        duplicate_results = 0
-                    else:
-                        duplicate_results += 1
-                    logger.info("XHR /pl/results page=%s: +%s карточек (итого %s)", next_page, added, len(items))
-                    try:
-                        meta = data.get("data") if isinstance(data, dict) else {}
-                        if isinstance(meta, dict):
-                            if meta.get("limit") is not None:
-                                captured_limit = max(int(meta.get("limit") or 0), captured_limit or 0)
-                            if meta.get("total") is not None:
-                                captured_total = int(meta.get("total"))
-                    except Exception:
-                        pass
-                    if arr and hints:
-                        next_hints = hints or next_hints
-                    ep_local = CapturedEndpoint(
-                        method="GET",
-                        url=new_url,
-                        req_headers=results_ep.req_headers if results_ep else base_headers,
-                        req_body=results_ep.req_body if results_ep else None,
-                        resp_json=data,
-                    )
-                    results_ep = ep_local
-                    last_ep = ep_local
-                    rounds_left_results -= 1
-                    next_page += 1
-                    if duplicate_results >= 2:
-                        break
-                    time.sleep(delay + random.uniform(0.05, 0.2))
+                    for new_url, r in zip(urls, responses):
+                        if len(items) >= max_items:
+                            stop = True
+                            break
+                        if r is None:
+                            logger.info("XHR /pl/results fetch %s упал — стоп.", new_url)
+                            stop = True
+                            break
+                        if not r.ok:
+                            logger.info("XHR GET %s -> HTTP %s — стоп.", new_url, r.status)
+                            stop = True
+                            break
+                        try:
+                            data = _json_loads(r.body())
+                        except Exception:
+                            logger.info("XHR /pl/results ответ не JSON — стоп.")
+                            stop = True
+                            break
+                        _dump_follow(new_url, data)
+                        arr, hints = _infer_array_and_next(data)
+                        if not arr and isinstance(data, dict):
+                            payload = data.get("data")
+                            if isinstance(payload, list) and payload and isinstance(payload[0], dict):
+                                arr = payload
+                                hints = {}
+                        if not arr:
+                            logger.info("XHR /pl/results: ответ без карточек — стоп.")
+                            stop = True
+                            break
+                        resp_ids, prods = _parse_xhr_arr(arr)
+                        added = _upsert_many(prods, cap=max_items)
+                        captured_ids.update(resp_ids)
+                        results_pages_seen.add(next_page)
+                        req_id_resp = _extract_request_id_from_data(data)
+                        if req_id_resp and results_params_template.get("requestId") != req_id_resp:
+                            results_params_template["requestId"] = req_id_resp
+                        if added:
+                            progress = True
+                            duplicate_results = 0
+                        else:
+                            duplicate_results += 1
+                        logger.info("XHR /pl/results page=%s: +%s карточек (итого %s)", next_page, added, len(items))
+                        try:
+                            meta = data.get("data") if isinstance(data, dict) else {}
+                            if isinstance(meta, dict):
+                                if meta.get("limit") is not None:
+                                    captured_limit = max(int(meta.get("limit") or 0), captured_limit or 0)
+                                if meta.get("total") is not None:
+                                    captured_total = int(meta.get("total"))
+                        except Exception:
+                            pass
+                        if arr and hints:
+                            next_hints = hints or next_hints
+                        ep_local = CapturedEndpoint(
+                            method="GET",
+                            url=new_url,
+                            req_headers=results_ep.req_headers if results_ep else base_headers,
+                            req_body=results_ep.req_body if results_ep else None,
+                            resp_json=data,
+                        )
+                        results_ep = ep_local
+                        last_ep = ep_local
+                        rounds_left_results -= 1
+                        next_page += 1
+                        if duplicate_results >= 2:
+                            stop = True
+                            break
+                    if not stop:
+                        _jitter_sleep(delay)
                 return progress
 
             results_progress = _run_results_pagination()
@@ -1998,8 +3441,7 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
             current_offset = max(len(captured_ids), len(items))
 
             # База — URL без page/i/offset; q санитайзим при необходимости
-            base_url_for_offset = _strip_params_page((first_ep or ep).url)
-            base_url_for_offset = _strip_params(base_url_for_offset, ["offset", "i", "start", "from"])
+            base_url_for_offset = _strip_query_params((first_ep or ep).url, ("page", "offset", "i", "start", "from"))
             if no_zone:
                 base_url_for_offset = _strip_zone_in_q(base_url_for_offset)
             env_params: Dict[str, str] = {"ui": "d", "fl": "true"}
@@ -2012,6 +3454,10 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
             preferred_all = "true"
             used_all_false = False
             duplicate_streak = 0
+            # base_url_for_offset -> (all, индекс в param_variants), давшие новые ID в прошлом раунде
+            good_variant_by_base: Dict[str, Tuple[str, int]] = {}
+            # Набор ключей варианта, который сервер уже принял (не зависит от base/offset)
+            learned_variant_shape: Optional[frozenset] = None
             while rounds_left > 0 and len(items) < max_items:
                 stride = max(1, limit_eff)
                 offset_to_use = current_offset
@@ -2046,29 +3492,64 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                 all_sequence = [preferred_all] + [v for v in ("true", "false") if v != preferred_all]
                 success_data = None
                 success_arr: Optional[List[dict]] = None
+                # ID из выбранного ответа, которых ещё нет в captured_ids (у фолбэка «без новых» — пусто)
+                success_new_ids: Set[str] = set()
                 success_hints: Dict[str, Optional[str]] = {}
                 success_url: Optional[str] = None
                 chosen_all = preferred_all
                 fallback_entry: Optional[Tuple[Dict[str, Any], List[dict], Dict[str, Optional[str]], str, str]] = None
                 last_status: Optional[Tuple[str, str]] = None
                 last_error: Optional[Exception] = None
+                chosen_variant = 0
 
+                # Сначала — сработавшая в прошлом раунде пара (all, вариант); полный перебор — только если она не дала новых ID
+                # затем варианты той же формы, что уже срабатывала, и только потом — остальные
+                memo = good_variant_by_base.get(base_url_for_offset)
+                probe_plan: List[Tuple[str, List[int]]] = [(memo[0], [memo[1]])] if memo else []
+                rest_plan: List[Tuple[str, List[int]]] = []
                 for all_val in all_sequence:
+                    shaped: List[int] = []
+                    rest: List[int] = []
+                    for i, variant in enumerate(param_variants):
+                        if (all_val, i) == memo:
+                            continue
+                        if learned_variant_shape is not None and frozenset(variant) == learned_variant_shape:
+                            shaped.append(i)
+                        else:
+                            rest.append(i)
+                    if shaped:
+                        probe_plan.append((all_val, shaped))
+                    if rest:
+                        rest_plan.append((all_val, rest))
+                probe_plan.extend(rest_plan)
+
+                for all_val, variant_idxs in probe_plan:
                     base_with_all = _set_query_params(base_url_for_offset, {"all": all_val})
-                    base_clean = _strip_params(base_with_all, ["offset", "start", "from", "page", "p", "pageNumber", "page_num", "i"])
-                    for variant in param_variants:
-                        variant_clean = {k: v for k, v in variant.items() if v is not None}
-                        new_url = _set_query_params(base_clean, variant_clean)
-                        try:
-                            r = req.get(new_url, timeout=25000, headers=base_headers)
-                        except Exception as e:
-                            last_error = e
+                    base_clean = _strip_query_params(base_with_all, _OFFSET_PAGING_KEYS)
+                    # база очищена от offset/page/i — варианты просто дописываем к ней
+                    variant_urls = [
+                        _append_query(base_clean, {k: v for k, v in param_variants[i].items() if v is not None})
+                        for i in variant_idxs
+                    ]
+                    # Варианты одного all=… запрашиваем параллельно (раунд стоит max, а не сумму задержек),
+                    # а разбираем в прежнем порядке приоритета
+                    fetch_errors: Dict[str, Exception] = {}
+                    try:
+                        responses = req.get_many(variant_urls, timeout=25000, headers=base_headers,
+                                                 workers=RESULTS_CONCURRENCY, errors=fetch_errors)
+                    except Exception as e:
+                        last_error = e
+                        continue
+                    for variant_idx, new_url, r in zip(variant_idxs, variant_urls, responses):
+                        if r is None:
+                            last_error = fetch_errors.get(new_url, last_error)
+                            last_status = (new_url, f"error: {last_error}" if last_error else "error")
                             continue
                         if not r.ok:
                             last_status = (new_url, str(r.status))
                             continue
                         try:
-                            data = r.json()
+                            data = _json_loads(r.body())
                         except Exception:
                             last_status = (new_url, "non-json")
                             continue
@@ -2088,7 +3569,7 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                                     except Exception:
                                         pass
                                     try:
-                                        results_base_url = _strip_params(new_url.replace("/pl/filters", "/pl/results"), ["offset", "i"])
+                                        results_base_url = _strip_query_params(new_url.replace("/pl/filters", "/pl/results"), ("offset", "i"))
                                     except Exception:
                                         results_base_url = new_url.replace("/pl/filters", "/pl/results")
                             except Exception:
@@ -2102,18 +3583,16 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                         if not arr:
                             last_status = (new_url, "empty")
                             continue
-                        has_new = False
-                        for obj in arr:
-                            pid = _id_from_obj(obj)
-                            if pid and pid not in captured_ids:
-                                has_new = True
-                                break
-                        if has_new:
+                        resp_ids = {pid for pid in map(_id_from_obj, arr) if pid}
+                        new_ids = resp_ids - captured_ids
+                        if new_ids:
+                            success_new_ids = new_ids
                             success_data = data
                             success_arr = arr
                             success_hints = hints
                             success_url = new_url
                             chosen_all = all_val
+                            chosen_variant = variant_idx
                             break
                         if fallback_entry is None:
                             fallback_entry = (data, arr, hints, new_url, all_val)
@@ -2124,6 +3603,9 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
 
                 if success_data is None and fallback_entry is not None:
                     success_data, success_arr, success_hints, success_url, chosen_all = fallback_entry
+                elif success_data is not None:
+                    good_variant_by_base[base_url_for_offset] = (chosen_all, chosen_variant)
+                    learned_variant_shape = frozenset(param_variants[chosen_variant])
 
                 if success_data is None or success_arr is None or success_url is None:
                     if last_status:
@@ -2134,8 +3616,7 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                         logger.info("XHR offset-пагинация: не удалось подобрать параметры — стоп.")
                     break
 
-                _save_dump("xhr_follow_req", {"method": "GET", "url": success_url, "body": ""})
-                _save_dump("xhr_follow_resp", {"url": success_url, "data": success_data})
+                _dump_follow(success_url, success_data)
 
                 data = success_data
                 arr = success_arr
@@ -2156,50 +3637,16 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                     pass
 
                 # Добавляем товары и пополняем internal seen для корректного шага offset
-                added = 0
-                new_ids_in_resp: Set[str] = set()
-                unique_new_ids: Set[str] = set()
-                for obj in arr:
-                    pid = _id_from_obj(obj)
-                    if pid:
-                        new_ids_in_resp.add(pid)
-                        if pid not in captured_ids:
-                            unique_new_ids.add(pid)
-                    title = obj.get("title") or obj.get("name") or ""
-                    urlp = obj.get("shopLink") or obj.get("url") or obj.get("href") or None
-                    if urlp and urlp.startswith("/"):
-                        urlp = "https://kaspi.kz" + urlp
-                    price_fields = [obj.get("unitSalePrice"), obj.get("unitPrice"), obj.get("priceFormatted"), obj.get("price"), obj.get("listPrice"), obj.get("minPrice"), obj.get("priceMin")]
-                    lp = None
-                    for pf in price_fields:
-                        lp = _regex_price_to_float(pf)
-                        if lp is not None:
-                            break
-                    rating_val = None
-                    try:
-                        rv = obj.get("rating")
-                        if rv is not None:
-                            rating_val = float(rv)
-                    except Exception:
-                        pass
-                    reviews_val = None
-                    try:
-                        rq = obj.get("reviewsQuantity")
-                        if isinstance(rq, (int, float)):
-                            reviews_val = int(rq)
-                    except Exception:
-                        pass
-                    if not title:
-                        continue
-                    it = Product(product_id=pid, title=title, url=urlp, list_price=lp, rating=rating_val, reviews=reviews_val)
-                    if _upsert(it):
-                        added += 1
+                unique_new_ids = success_new_ids
+                added = _upsert_many(map(_xhr_page_card, arr), cap=max_items)
 
                 # обновим счётчики endpoint seen независимо от того, были ли дубли в общем items
-                for pid in unique_new_ids:
-                    captured_ids.add(pid)
+                captured_ids.update(unique_new_ids)
+                # размеры до конца раунда не меняются — берём один раз
+                n_items = len(items)
+                n_captured = len(captured_ids)
 
-                logger.info("XHR offset-пагинация: +%s карточек (итого %s)", added, len(items))
+                logger.info("XHR offset-пагинация: +%s карточек (итого %s)", added, n_items)
                 if added > 0:
                     added_any_xhr = True
 
@@ -2210,7 +3657,7 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                 if unique_new_ids:
                     duplicate_streak = 0
                     used_all_false = False
-                    current_offset = max(candidate_offset, len(captured_ids), len(items))
+                    current_offset = max(candidate_offset, n_captured, n_items)
                 else:
                     # если дубликаты — попробуем один раз переключиться на all=false и повторить тот же offset
                     if chosen_all != "false" and not used_all_false:
@@ -2220,7 +3667,7 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                         )
                         preferred_all = "false"
                         current_offset = prev_offset
-                        time.sleep(delay + random.uniform(0.05, 0.2))
+                        _jitter_sleep(delay)
                         continue
 
                     duplicate_streak += 1
@@ -2245,7 +3692,7 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                     req_body=ep.req_body,
                     resp_json=data,
                 )
-                time.sleep(delay + random.uniform(0.05, 0.2))
+                _jitter_sleep(delay)
 
             if not results_progress and results_params_template.get("requestId") and len(items) < max_items:
                 try:
@@ -2261,7 +3708,7 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                 try:
                     logger.info("Пробуем XHR по page=N.")
                     # на всякий случай уберём offset и служебные индексы, и возьмём базу из первого UI XHR
-                    base_url_for_page = _strip_params((first_ep or ep).url, ["offset", "i"])  # убираем offset, i
+                    base_url_for_page = _strip_query_params((first_ep or ep).url, ("offset", "i"))  # убираем offset, i
                     if no_zone:
                         base_url_for_page = _strip_zone_in_q(base_url_for_page)
                     # добавим обязательные параметры окружения
@@ -2278,9 +3725,7 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                         start_page_num = 2  # page=1 обычно первая выдача
                         # если в исходном URL уже был page — начнём с +1
                         try:
-                            from urllib.parse import urlparse, parse_qs
-                            pr0 = urlparse(base_url_for_page)
-                            qs0 = parse_qs(pr0.query)
+                            _, qs0 = _parse_url_qs(base_url_for_page)
                             if qs0.get("page"):
                                 sp = int(qs0["page"][0])
                                 start_page_num = max(2, sp + 1)
@@ -2289,71 +3734,61 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
                         pg = start_page_num
                         # Две подряд пустые страницы — стоп
                         empty_streak = 0
-                        while page_rounds_left > 0 and len(items) < max_items:
-                            # усиливаем окружение: ui=d, fl=true, i=pg
-                            url_with_env = _set_query_params(base_url_for_page, {"all": all_value, "ui": "d", "fl": "true"})
-                            offset_val = max(0, pg * max(1, limit_eff))
-                            new_url = _set_query_params(url_with_env, {"page": str(pg), "i": str(pg), "offset": str(offset_val)})
+                        # усиливаем окружение: ui=d, fl=true, i=pg
+                        url_with_env = _set_query_params(base_url_for_page, {"all": all_value, "ui": "d", "fl": "true"})
+                        # база разбирается один раз: page/i/offset вычищаем и дальше только дописываем
+                        page_base = _strip_query_params(url_with_env, ("page", "i", "offset"))
+                        stride = max(1, limit_eff)
+                        stop = False
+                        while not stop and page_rounds_left > 0 and len(items) < max_items:
+                            # Окно из RESULTS_CONCURRENCY страниц запрашиваем параллельно, разбираем по порядку
+                            # с прежними условиями остановки; недоразобранный хвост окна просто отбрасываем
+                            window = list(range(pg, pg + min(RESULTS_CONCURRENCY, page_rounds_left)))
+                            urls = [
+                                _append_query(page_base, {"page": str(n), "i": str(n), "offset": str(max(0, n * stride))})
+                                for n in window
+                            ]
                             try:
-                                r2 = req.get(new_url, timeout=25000, headers=base_headers)
+                                responses = req.get_many(urls, timeout=25000, headers=base_headers,
+                                                         workers=RESULTS_CONCURRENCY)
                             except Exception as e:
                                 logger.info("XHR page fetch упал: %s — стоп.", e)
                                 break
-                            if not r2.ok:
-                                logger.info("XHR GET %s -> HTTP %s — стоп.", new_url, r2.status)
-                                break
-                            try:
-                                data2 = r2.json()
-                            except Exception:
-                                logger.info("Ответ не JSON — стоп.")
-                                break
-                            _save_dump("xhr_follow_req", {"method": "GET", "url": new_url, "body": ""})
-                            _save_dump("xhr_follow_resp", {"url": new_url, "data": data2})
-                            arr2, _ = _infer_array_and_next(data2)
-                            if not arr2:
-                                logger.info("Ответ без массива карточек — стоп.")
-                                break
-                            added2 = 0
-                            for obj in arr2:
-                                pid = (obj.get("productId") or obj.get("id") or obj.get("configSku") or obj.get("product_id"))
-                                pid = str(pid) if pid is not None else None
-                                title = obj.get("title") or obj.get("name") or ""
-                                urlp = obj.get("shopLink") or obj.get("url") or obj.get("href") or None
-                                if urlp and urlp.startswith("/"):
-                                    urlp = "https://kaspi.kz" + urlp
-                                price_fields = [obj.get("unitSalePrice"), obj.get("unitPrice"), obj.get("priceFormatted"), obj.get("price"), obj.get("listPrice"), obj.get("minPrice"), obj.get("priceMin")]
-                                lp = None
-                                for pf in price_fields:
-                                    lp = _regex_price_to_float(pf)
-                                    if lp is not None:
-                                        break
-                                rating_val = None
-                                try:
-                                    rv = obj.get("rating")
-                                    if rv is not None:
-                                        rating_val = float(rv)
-                                except Exception:
-                                    pass
-                                reviews_val = None
+                            for n, new_url, r2 in zip(window, urls, responses):
+                                if len(items) >= max_items:
+                                    stop = True
+                                    break
+                                if r2 is None:
+                                    logger.info("XHR page fetch %s упал — стоп.", new_url)
+                                    stop = True
+                                    break
+                                if not r2.ok:
+                                    logger.info("XHR GET %s -> HTTP %s — стоп.", new_url, r2.status)
+                                    stop = True
+                                    break
                                 try:
-                                    rq = obj.get("reviewsQuantity")
-                                    if isinstance(rq, (int, float)):
-                                        reviews_val = int(rq)
+                                    data2 = _json_loads(r2.body())
                                 except Exception:
-                                    pass
-                                if not title:
-                                    continue
-                                it = Product(product_id=pid, title=title, url=urlp, list_price=lp, rating=rating_val, reviews=reviews_val)
-                                if _upsert(it):
-                                    added2 += 1
-                            logger.info("XHR page=%s (all=%s): +%s карточек (итого %s)", pg, all_value, added2, len(items))
-                            any_added = any_added or (added2 > 0)
-                            page_rounds_left -= 1
-                            pg += 1
-                            empty_streak = empty_streak + 1 if added2 == 0 else 0
-                            if empty_streak >= 2:
-                                break
-                            time.sleep(delay + random.uniform(0.05, 0.2))
+                                    logger.info("Ответ не JSON — стоп.")
+                                    stop = True
+                                    break
+                                _dump_follow(new_url, data2)
+                                arr2, _ = _infer_array_and_next(data2)
+                                if not arr2:
+                                    logger.info("Ответ без массива карточек — стоп.")
+                                    stop = True
+                                    break
+                                added2 = _upsert_many(map(_xhr_page_card, arr2), cap=max_items)
+                                logger.info("XHR page=%s (all=%s): +%s карточек (итого %s)", n, all_value, added2, len(items))
+                                any_added = any_added or (added2 > 0)
+                                page_rounds_left -= 1
+                                pg = n + 1
+                                empty_streak = empty_streak + 1 if added2 == 0 else 0
+                                if empty_streak >= 2:
+                                    stop = True
+                                    break
+                            if not stop:
+                                _jitter_sleep(delay)
                         return any_added
 
                     progress = _page_loop("true")
@@ -2366,21 +3801,28 @@ def _collect_one_query(query_text: str, pages:int, delay:float, headful:bool, mo
             _integrate_pending_xhr("перед деталями")
 
         logger.info("Обогащение detail (rating/reviews + min=default=list_price) ...")
-        items = _enrich_detail_min_price_and_meta(ctx, items, limit=min(detail_limit, len(items)), delay=max(0.4, delay-0.3))
-        browser.close()
+        try:
+            detail_referer = page.url
+        except Exception:
+            detail_referer = entry_used or cat_url
+        items = _enrich_detail_min_price_and_meta(ctx, items, limit=min(detail_limit, len(items)),
+                                                  api=api, http_headers={
+                                                      "user-agent": _ctx_opts(profile_idx)["user_agent"],
+                                                      "referer": detail_referer or KASPI_ORIGIN + "/",
+                                                  })
 
     return items
 
 # ---------------------- Orchestrate brand-splitting ----------------------
 DEFAULT_BRANDS = ["apple","samsung","xiaomi","realme","huawei","oppo","vivo","tecno","infinix"]
 
-def _merge_products(dest: List[Product], src: Iterable[Product]) -> List[Product]:
-    seen: Set[Tuple] = set()
-    for it in dest:
-        seen.add((it.product_id, it.title))
+def _merge_products(dest: List[Product], src: Iterable[Product], seen: Set[str]) -> List[Product]:
+    """seen — ключи уже лежащих в dest карточек; вызывающий держит его между мерджами,
+    чтобы не пересобирать по всему dest на каждый бренд."""
     added = 0
     for it in src:
-        key = (it.product_id, it.title)
+        # тот же ключ, что у апсерта в _collect_one_query: product_id, без него — title|list_price
+        key = it.product_id or f"{it.title}|{it.list_price or ''}"
         if key in seen:
             continue
         seen.add(key)
@@ -2390,22 +3832,132 @@ def _merge_products(dest: List[Product], src: Iterable[Product]) -> List[Product
         logger.info("Мердж: добавлено %s новых карточек (итого %s)", added, len(dest))
     return dest
 
+def _collect_brands_parallel(query_text: str, pages: int, delay: float, headful: bool, mode: str,
+                             max_items: int, detail_limit: int, brands: List[str], no_zone: bool,
+                             category: str, proxy: Optional[str], sort: str, human_simulation: bool,
+                             human_brand: Optional[str], workers: int) -> List[Product]:
+    """Бренды параллельно (workers потоков): у каждого потока свой playwright/браузер —
+    sync-объекты Playwright между потоками не передаются. Браузер поднимается один раз на поток,
+    бренды воркеры разбирают из общей очереди. Мерджим в порядке brands; бренд получает
+    остаток лимита на момент старта."""
+    all_items: List[Product] = []
+    seen_keys: Set[str] = set()
+    todo: "queue.Queue[Tuple[str, Future]]" = queue.Queue()
+    futures: List[Tuple[str, Future]] = []
+    for b in brands:
+        fut: Future = Future()
+        todo.put((b, fut))
+        futures.append((b, fut))
+    stop = threading.Event()
+
+    def _one(b: str, browser) -> List[Product]:
+        cap = max_items - len(all_items)
+        if cap <= 0:
+            return []
+        logger.info("=== Бренд '%s' ===", b)
+        return _collect_one_query(
+            f"{query_text} {b}", pages, delay, headful, mode,
+            max_items=cap, detail_limit=detail_limit, no_zone=no_zone,
+            category=category, proxy=proxy, sort=sort,
+            human_simulation=human_simulation, human_brand=human_brand, browser=browser,
+        )
+
+    def _drain(run: Callable[[str], List[Product]]) -> None:
+        while not stop.is_set():
+            try:
+                b, fut = todo.get_nowait()
+            except queue.Empty:
+                return
+            if not fut.set_running_or_notify_cancel():
+                continue
+            try:
+                fut.set_result(run(b))
+            except Exception as e:
+                fut.set_exception(e)
+
+    alive = [workers]
+    alive_lock = threading.Lock()
+
+    def _worker() -> None:
+        err: Optional[Exception] = None
+        try:
+            with browser_session(headful, proxy) as browser:
+                _drain(lambda b: _one(b, browser))
+        except Exception as e:
+            # браузер не поднялся — очередь оставляем живым воркерам
+            logger.info("Воркер брендов без браузера: %s", e)
+            err = e
+        finally:
+            with alive_lock:
+                alive[0] -= 1
+                last = alive[0] == 0
+            if last:
+                # живых воркеров не осталось — остаток очереди завершаем ошибкой, чтобы его не ждать вечно
+                def _fail(_b: str) -> List[Product]:
+                    raise err or RuntimeError("нет воркеров с браузером")
+                _drain(_fail)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for _ in range(workers):
+            pool.submit(_worker)
+        for b, fut in futures:
+            if len(all_items) >= max_items:
+                # ещё не начатые бренды не запускаем
+                stop.set()
+                fut.cancel()
+                continue
+            try:
+                chunk = fut.result()
+            except Exception as e:
+                logger.info("Бренд '%s' не собран: %s", b, e)
+                continue
+            _merge_products(all_items, chunk, seen_keys)
+    del all_items[max_items:]
+    return all_items
+
 # ---------------------- Public API ----------------------
 def collect(query_text: str, pages:int, delay:float, headful:bool=False,
             mode:str="both", max_items:int=200, detail_limit:int=24,
             split_by_brand:bool=False, brands:Optional[List[str]]=None,
             no_zone:bool=True, category:str="smartphones", proxy: Optional[str] = "",
-            sort: str = "", human_simulation: bool = False, human_brand: Optional[str] = None) -> List[Product]:
+            sort: str = "", human_simulation: bool = False, human_brand: Optional[str] = None,
+            browser=None) -> List[Product]:
+    """browser — общий chromium из browser_session(); без него запускается свой на время вызова."""
 
     if not split_by_brand:
         return _collect_one_query(
             query_text, pages, delay, headful, mode, max_items, detail_limit,
             no_zone, category=category, proxy=proxy, sort=sort,
-            human_simulation=human_simulation, human_brand=human_brand,
+            human_simulation=human_simulation, human_brand=human_brand, browser=browser,
         )
 
     brands = brands or DEFAULT_BRANDS
+    # Параллельно — только по явному KASPI_BRAND_CONCURRENCY>1 и без переданного browser:
+    # чужой sync-браузер из других потоков трогать нельзя, поэтому с ним бренды идут по очереди
+    if browser is None and BRAND_CONCURRENCY > 1 and len(brands) > 1:
+        slots = _take_brand_slots(min(BRAND_CONCURRENCY, len(brands)))
+        try:
+            if slots > 1:
+                return _collect_brands_parallel(
+                    query_text, pages, delay, headful, mode, max_items, detail_limit, brands,
+                    no_zone=no_zone, category=category, proxy=proxy, sort=sort,
+                    human_simulation=human_simulation, human_brand=human_brand, workers=slots,
+                )
+        finally:
+            _give_brand_slots(slots)
+
+    if browser is None:
+        # все бренды — в одном chromium, по контексту на бренд
+        with browser_session(headful, proxy) as shared:
+            return collect(
+                query_text, pages, delay, headful, mode, max_items, detail_limit,
+                split_by_brand=True, brands=brands, no_zone=no_zone, category=category,
+                proxy=proxy, sort=sort, human_simulation=human_simulation,
+                human_brand=human_brand, browser=shared,
+            )
+
     all_items: List[Product] = []
+    seen_keys: Set[str] = set()
     cap = max_items
 
     for b in brands:
@@ -2418,23 +3970,54 @@ def collect(query_text: str, pages:int, delay:float, headful:bool=False,
             max_items=cap - len(all_items),
             detail_limit=detail_limit, no_zone=no_zone,
             category=category, proxy=proxy, sort=sort,
-            human_simulation=human_simulation, human_brand=human_brand,
+            human_simulation=human_simulation, human_brand=human_brand, browser=browser,
         )
-        _merge_products(all_items, chunk)
+        _merge_products(all_items, chunk, seen_keys)
         # небольшая пауза между брендами
         time.sleep(max(0.2, delay - 0.3))
 
     return all_items
 
+CSV_FIELDS = ["product_id","title","url","list_price","price_min","price_default",
+              "rating","reviews","offers_count","best_merchant","errors"]
+_CSV_ROW = operator.attrgetter(*CSV_FIELDS)
+
+# Запись CSV через pyarrow — только по явному KASPI_ARROW_CSV=1: формат отличается от csv.writer
+# (заголовок и все строки в кавычках, float без ".0", переводы строк \n вместо \r\n) — см. README
+ARROW_CSV = bool(int(os.getenv("KASPI_ARROW_CSV", "0")))
+
+def _save_csv_arrow(items: List[Product], path: str) -> bool:
+    """Колоночная запись через pyarrow.csv: столбцы собираются один раз, а не построчно."""
+    if not ARROW_CSV:
+        return False
+    try:
+        import pyarrow as pa  # type: ignore
+        import pyarrow.csv as pacsv  # type: ignore
+    except Exception:
+        return False
+    try:
+        # строки тем же attrgetter, что и у csv.writer, затем транспонируем zip'ом — один проход по items
+        rows = list(map(_CSV_ROW, items))
+        cols = {name: list(col) for name, col in zip(CSV_FIELDS, zip(*rows))} if rows else {name: [] for name in CSV_FIELDS}
+        table = pa.table(cols)
+        pacsv.write_csv(table, path, write_options=pacsv.WriteOptions(quoting_style="needed"))
+        return True
+    except Exception as e:
+        # смешанные типы в колонке / старый pyarrow без quoting_style — пишем по-старому
+        logger.debug("pyarrow CSV не удалось (%s) — csv.writer", e)
+        return False
+
 def save_csv(items: List[Product], path: str):
-    fieldnames = ["product_id","title","url","list_price","price_min","price_default",
-                  "rating","reviews","offers_count","best_merchant","errors"]
     _ensure_dir(os.path.dirname(path) or ".")
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=fieldnames)
-        w.writeheader()
-        for it in items:
-            w.writerow(asdict(it))
+    if _save_csv_arrow(items, path):
+        logger.info("CSV сохранён: %s (%s строк)", path, len(items))
+        return
+    # буфер 1 МБ: строки копятся в памяти, а не уходят в файл мелкими write()
+    with open(path, "w", newline="", encoding="utf-8", buffering=1 << 20) as f:
+        # attrgetter отдаёт кортеж полей напрямую — без dict на каждую строку
+        w = csv.writer(f)
+        w.writerow(CSV_FIELDS)
+        w.writerows(map(_CSV_ROW, items))
     logger.info("CSV сохранён: %s (%s строк)", path, len(items))
 
 def main():
@@ -2446,7 +4029,13 @@ def main():
     p.add_argument("--delay", type=float, default=0.9)
     p.add_argument("--headful", action="store_true")
     p.add_argument("--save-dumps", action="store_true", help="Save XHR dumps to logs/ directory")
+    p.add_argument("--block-assets", action="store_true", help="Не грузить картинки/шрифты/стили/трекеры (то же, что KASPI_BLOCK_ASSETS=1)")
+    p.add_argument("--cache-ttl", type=float, default=None, help="TTL (сек) дискового кэша JSON-ответов листинга в .cache/kaspi (то же, что KASPI_HTTP_CACHE_TTL)")
     p.add_argument("--proxy", default="", help="Playwright proxy, e.g., http://host:port")
+    p.add_argument("--reuse-context", action="store_true", help="Один контекст (куки/соединения) на все запросы общего браузера (то же, что KASPI_REUSE_CONTEXT=1)")
+    p.add_argument("--rotate-ua", action="store_true", help="Ротировать UA/viewport по контекстам (то же, что KASPI_ROTATE_UA=1)")
+    p.add_argument("--no-httpx", action="store_true", help="XHR-пагинация только через Playwright (без httpx/HTTP2)")
+    p.add_argument("--cdp-endpoint", default="", help="Подключиться к уже запущенному chromium (например, http://127.0.0.1:9222) вместо запуска своего; см. launch_cdp.sh")
     p.add_argument("--mode", choices=["both","category","search"], default="both")
     p.add_argument("--max-items", type=int, default=200)
     p.add_argument("--detail-limit", type=int, default=24)
@@ -2466,9 +4055,21 @@ def main():
     if args.split_by_brand and args.brands.strip():
         brands_list = [s.strip() for s in args.brands.split(",") if s.strip()]
     # enable dumps if requested
-    global SAVE_DUMPS
+    global SAVE_DUMPS, BLOCK_ASSETS, HTTP_CACHE_TTL, CDP_ENDPOINT, HTTPX_PAGINATION, ROTATE_UA, REUSE_CONTEXT
     if args.save_dumps:
         SAVE_DUMPS = True
+    if args.block_assets:
+        BLOCK_ASSETS = True
+    if args.cache_ttl is not None:
+        HTTP_CACHE_TTL = max(0.0, args.cache_ttl)
+    if args.cdp_endpoint.strip():
+        CDP_ENDPOINT = args.cdp_endpoint.strip()
+    if args.no_httpx:
+        HTTPX_PAGINATION = False
+    if args.rotate_ua:
+        ROTATE_UA = True
+    if args.reuse_context:
+        REUSE_CONTEXT = True
 
     human_brand = args.human_brand.strip() or None
 
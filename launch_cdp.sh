@@ -0,0 +1,15 @@
+#!/usr/bin/env bash
+# Общий headless chromium для воркеров скрейпера:
+#   ./launch_cdp.sh &
+#   python etl/scrape_kaspi.py --cdp-endpoint http://127.0.0.1:9222 ...
+# (или KASPI_CDP_ENDPOINT=http://127.0.0.1:9222 для run_etl/batch_runner)
+set -euo pipefail
+
+PORT="${KASPI_CDP_PORT:-9222}"
+PROFILE_DIR="${KASPI_CDP_PROFILE:-/tmp/kaspi}"
+CHROMIUM_BIN="${CHROMIUM_BIN:-chromium}"
+
+exec "$CHROMIUM_BIN" --headless=new \
+  --remote-debugging-port="$PORT" \
+  --user-data-dir="$PROFILE_DIR" \
+  --no-first-run --no-default-browser-check